@@ -36,15 +36,27 @@
 
 from ConfigParser import SafeConfigParser
 from optparse import OptionParser
-import copy
+import cPickle as pickle
+import collections
+import ctypes
+import ctypes.util
 import graphios_backends as backends
+import json
 import logging
 import logging.handlers
+import multiprocessing
+import operator
 import os
 import os.path
+import Queue
 import re
+import select
+import signal
+import struct
 import sys
+import threading
 import time
+import zlib
 
 
 # ##########################################################
@@ -70,6 +82,12 @@ cfg = {}
 # backend global
 be = ""
 
+# process pool for parse_workers, started by init_parse_pool
+parse_pool = None
+
+# how long to wait on a parse worker before we give up on it (in seconds)
+parse_timeout = 3600
+
 # available loglevels for graphios.cfg
 loglevels = {
     'logging.DEBUG':    logging.DEBUG,
@@ -118,40 +136,93 @@ parser.add_option("--reverse_hostname", action="store_true",
 
 log = logging.getLogger('log')
 
+# precompiled patterns for the spool line parser. A perfdata item looks like
+# 'label'=value[UOM];[warn];[crit];[min];[max] and the label only needs the
+# single quotes when it contains spaces.
+PERFDATA_RE = re.compile(r"\s*('(?:[^']|'')*'|[^\s=]+)=([^;\s]*)(\S*)\s*")
+NOT_SPACE_RE = re.compile(r"\s*\S+\s*")
+# a perfdata value is a number followed by an optional UOM (s, ms, %, KB, c..)
+VALUE_RE = re.compile(r"([-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?)"
+                      r"([a-zA-Z%]*)$")
+QUOTE_CHARS = "'\""
+# the spaces of quoted labels, no backend wants them in a metric name
+LABEL_SPACE_RE = re.compile(r"\s")
+
+# returned by parse_value for values we can't send anywhere (eg. 'U')
+INVALID = None
+
+# number of unparseable values dropped since startup
+invalid_values = 0
+INFINITY = float("inf")
 
-class GraphiosMetric(object):
-    def __init__(self):
-        self.LABEL = ''                 # The name in the perfdata from nagios
-        self.VALUE = ''                 # The measured value of that metric
-        self.UOM = ''                   # The unit of measure for the metric
-        self.DATATYPE = ''              # HOSTPERFDATA|SERVICEPERFDATA
-        self.METRICTYPE = 'gauge'       # gauge|counter|timer etc..
-        self.TIMET = ''                 # Epoc time the measurement was taken
-        self.HOSTNAME = ''              # name of th host measured
-        self.SERVICEDESC = ''           # nagios configured service description
-        self.PERFDATA = ''              # the space-delimited raw perfdata
-        self.SERVICECHECKCOMMAND = ''   # literal check command syntax
-        self.HOSTCHECKCOMMAND = ''      # literal check command syntax
-        self.HOSTSTATE = ''             # current state afa nagios is concerned
-        self.HOSTSTATETYPE = ''         # HARD|SOFT
-        self.SERVICESTATE = ''          # current state afa nagios is concerned
-        self.SERVICESTATETYPE = ''      # HARD|SOFT
-        self.METRICBASEPATH = ''        # Establishes a root base path
-        self.GRAPHITEPREFIX = ''        # graphios prefix
-        self.GRAPHITEPOSTFIX = ''       # graphios suffix
-        self.VALID = False              # if this metric is valid
 
+class GraphiosCheck(object):
+    """
+    The part of a metric that comes from the spool line itself. It is built
+    once per line and shared (read-only) by the GraphiosMetric of every
+    perfdata label in that line.
+    """
+    __slots__ = ('DATATYPE', 'METRICTYPE', 'TIMET', 'HOSTNAME', 'SERVICEDESC',
+                 'PERFDATA', 'SERVICECHECKCOMMAND', 'HOSTCHECKCOMMAND',
+                 'HOSTSTATE', 'HOSTSTATETYPE', 'SERVICESTATE',
+                 'SERVICESTATETYPE', 'METRICBASEPATH', 'GRAPHITEPREFIX',
+                 'GRAPHITEPOSTFIX', 'VALID', 'EXTRA')
+
+    def __init__(self, fields):
+        values = {
+            'DATATYPE': '',             # HOSTPERFDATA|SERVICEPERFDATA
+            'METRICTYPE': 'gauge',      # gauge|counter|timer etc..
+            'TIMET': '',                # Epoc time the measurement was taken
+            'HOSTNAME': '',             # name of th host measured
+            'SERVICEDESC': '',          # nagios configured service description
+            'PERFDATA': '',             # the space-delimited raw perfdata
+            'SERVICECHECKCOMMAND': '',  # literal check command syntax
+            'HOSTCHECKCOMMAND': '',     # literal check command syntax
+            'HOSTSTATE': '',            # current state afa nagios is concerned
+            'HOSTSTATETYPE': '',        # HARD|SOFT
+            'SERVICESTATE': '',         # current state afa nagios is concerned
+            'SERVICESTATETYPE': '',     # HARD|SOFT
+            'METRICBASEPATH': '',       # Establishes a root base path
+            'GRAPHITEPREFIX': '',       # graphios prefix
+            'GRAPHITEPOSTFIX': '',      # graphios suffix
+        }
         if 'metric_base_path' in cfg:
-            self.METRICBASEPATH = cfg['metric_base_path']
+            values['METRICBASEPATH'] = cfg['metric_base_path']
+
+        extra = {}  # any other macros somebody put in their perfdata template
+        for (name, value) in fields.iteritems():
+            if name in values:
+                values[name] = value
+            else:
+                extra[name] = value
+        values['HOSTNAME'] = self.check_adjust_hostname(values['HOSTNAME'])
+
+        # the same hosts and services show up in every spool file, so share
+        # one copy of those strings instead of one per line.
+        set_field = object.__setattr__
+        for (name, value) in values.iteritems():
+            if name != 'PERFDATA':
+                value = intern(value)
+            set_field(self, name, value)
+        set_field(self, 'EXTRA', extra)
+        set_field(self, 'VALID', self.validate())
+
+    def __setattr__(self, name, value):
+        raise AttributeError("GraphiosCheck is read-only")
+
+    def __reduce__(self):
+        # pickled when parse_workers send their metrics back to us
+        return (restore_check, (tuple([getattr(self, name)
+                                       for name in self.__slots__]),))
+
+    def __getattr__(self, name):
+        # only called for names that aren't slots
+        try:
+            return self.EXTRA[name]
+        except KeyError:
+            raise AttributeError(name)
 
     def validate(self):
-        # because we eliminated all whitespace, there shouldn't be any quotes
-        # this happens more with windows nagios plugins
-        re.sub("'", "", self.LABEL)
-        re.sub('"', "", self.LABEL)
-        re.sub("'", "", self.VALUE)
-        re.sub('"', "", self.VALUE)
-        self.check_adjust_hostname()
         if (
             self.TIMET is not '' and
             self.PERFDATA is not '' and
@@ -159,7 +230,7 @@ class GraphiosMetric(object):
         ):
             if "use_service_desc" in cfg and cfg["use_service_desc"] is True:
                 if self.SERVICEDESC != '' or self.DATATYPE == 'HOSTPERFDATA':
-                    self.VALID = True
+                    return True
             else:
                 # not using service descriptions
                 if (
@@ -169,16 +240,72 @@ class GraphiosMetric(object):
                     self.GRAPHITEPREFIX == "" and
                     self.GRAPHITEPOSTFIX == ""
                 ):
-                    self.VALID = False
+                    return False
                 else:
-                    self.VALID = True
+                    return True
+        return False
 
-    def check_adjust_hostname(self):
+    def check_adjust_hostname(self, hostname):
         if cfg["reverse_hostname"]:
-            self.HOSTNAME = '.'.join(reversed(self.HOSTNAME.split('.')))
+            hostname = '.'.join(reversed(hostname.split('.')))
         if cfg["replace_hostname"]:
-            self.HOSTNAME = self.HOSTNAME.replace(".",
-                                                  cfg["replacement_character"])
+            hostname = hostname.replace(".", cfg["replacement_character"])
+        return hostname
+
+
+class GraphiosMetric(object):
+    """
+    One perfdata label of a check. Only the label specific values live here,
+    everything else (HOSTNAME, SERVICEDESC, TIMET etc..) is read through to
+    the shared GraphiosCheck, so backends can keep using m.HOSTNAME.
+    """
+    __slots__ = ('header', 'LABEL', 'VALUE', 'VALUETEXT', 'UOM', 'THRESHOLDS')
+
+    def __init__(self, header, label='', value=0, text='0', uom='',
+                 thresholds=''):
+        self.header = header            # the GraphiosCheck this came from
+        self.LABEL = label              # The name in the perfdata from nagios
+        self.VALUE = value              # The measured value (int or float)
+        self.VALUETEXT = text           # VALUE formatted once for backends
+        self.UOM = uom                  # The unit of measure for the metric
+        self.THRESHOLDS = thresholds    # ';warn;crit;min;max' as in perfdata
+
+    def __getattr__(self, name):
+        # only called for names that aren't slots or header properties
+        return getattr(self.header, name)
+
+    def __reduce__(self):
+        # the header is only pickled once for all the labels that share it
+        return (restore_metric, (self.header, self.LABEL, self.VALUE,
+                                 self.VALUETEXT, self.UOM, self.THRESHOLDS))
+
+
+def restore_check(values):
+    """
+    unpickles a GraphiosCheck without validating it again
+    """
+    header = object.__new__(GraphiosCheck)
+    for ((set_field, shared), value) in zip(CHECK_SETTERS, values):
+        if shared and isinstance(value, str):
+            value = intern(value)
+        set_field(header, value)
+    return header
+
+
+def restore_metric(header, label, value, text, uom, thresholds=''):
+    """
+    unpickles a GraphiosMetric
+    """
+    return GraphiosMetric(header, intern(label), value, text, uom,
+                          thresholds)
+
+
+for _field in GraphiosCheck.__slots__:
+    setattr(GraphiosMetric, _field,
+            property(operator.attrgetter("header.%s" % _field)))
+# (slot setter, intern it) for every field, used by restore_check
+CHECK_SETTERS = [(GraphiosCheck.__dict__[_field].__set__,
+                  _field != 'PERFDATA') for _field in GraphiosCheck.__slots__]
 
 
 def chk_bool(value):
@@ -317,6 +444,17 @@ def handle_backends(opts):
         sys.exit(1)
 
 
+def get_int_option(name, default):
+    """
+    returns cfg[name] as an integer, or default if it isn't set
+    """
+    try:
+        return int(cfg.get(name, default))
+    except ValueError:
+        print "%s needs to be a integer" % name
+        sys.exit(1)
+
+
 def configure():
     """
     sets up graphios config
@@ -327,6 +465,21 @@ def configure():
     except ValueError:
         print "log_max_size needs to be a integer"
         sys.exit(1)
+    cfg["stream_batch_size"] = get_int_option("stream_batch_size", 0)
+    cfg["parse_workers"] = get_int_option("parse_workers", 1)
+    cfg["pipeline_depth"] = get_int_option("pipeline_depth", 0)
+    cfg["backend_deadline"] = get_int_option("backend_deadline", 0)
+    cfg["breaker_failures"] = get_int_option("breaker_failures", 3)
+    cfg["breaker_backoff"] = get_int_option("breaker_backoff", 15)
+    cfg["breaker_backoff_max"] = get_int_option("breaker_backoff_max", 480)
+    cfg["batch_max_metrics"] = get_int_option("batch_max_metrics", 0)
+    cfg["batch_max_bytes"] = get_int_option("batch_max_bytes", 0)
+    cfg["batch_max_age"] = get_int_option("batch_max_age", 0)
+    cfg["queue_segment_bytes"] = get_int_option("queue_segment_bytes",
+                                                16 * 1024 * 1024)
+    cfg["queue_max_bytes"] = get_int_option("queue_max_bytes",
+                                            1024 * 1024 * 1024)
+    cfg["queue_drain_metrics"] = get_int_option("queue_drain_metrics", 1000)
 
     # Convert cfg["log_max_size"] to bytes. Assume its already in bytes
     # if its > 1000000
@@ -362,66 +515,155 @@ def process_log(file_name):
     DATATYPE::HOSTPERFDATA  TIMET::1399738074 etc..
     """
     processed_objects = []  # the final list of metric objects we'll return
+    for batch in stream_log(file_name, 0):
+        processed_objects.extend(batch)
+    return processed_objects
+
+
+def stream_log(file_name, batch_size):
+    """
+    generator version of process_log, reads the file line by line and yields
+    lists of at most batch_size GraphiosMetric objects as soon as they are
+    parsed. If batch_size is 0 the whole file is yielded as one list.
+    """
+    batch = []
     graphite_lines = 0  # count the number of valid lines we process
+    num_metrics = 0
+    num_invalid = invalid_values
+    parse_time = 0.0
     try:
         host_data_file = open(file_name, "r")
-        file_array = host_data_file.readlines()
-        host_data_file.close()
     except (IOError, OSError) as ex:
         log.critical("Can't open file:%s error: %s" % (file_name, ex))
         sys.exit(2)
-    # parse each line into a metric object
-    for line in file_array:
-        if not re.search("^DATATYPE::", line):
+    try:
+        for line in host_data_file:
+            if not line.startswith("DATATYPE::"):
+                continue
+            graphite_lines += 1
+            start = time.time()
+            batch.extend(parse_line(line))
+            parse_time += time.time() - start
+            while batch_size > 0 and len(batch) >= batch_size:
+                num_metrics += batch_size
+                yield batch[:batch_size]
+                batch = batch[batch_size:]
+    except (IOError, OSError) as ex:
+        log.critical("Can't read file:%s error: %s" % (file_name, ex))
+        sys.exit(2)
+    finally:
+        host_data_file.close()
+    num_metrics += len(batch)
+    num_invalid = invalid_values - num_invalid
+    log_parse_cost(file_name, graphite_lines, num_metrics, num_invalid,
+                   parse_time)
+    if batch:
+        yield batch
+
+
+def log_parse_cost(file_name, lines, metrics, invalid, elapsed):
+    """
+    logs how long it took to parse a spool file, and the cost per line
+    """
+    if invalid > 0:
+        log.info("dropped %s invalid values from %s" % (invalid, file_name))
+    if lines > 0:
+        per_line = elapsed / lines * 1000000
+    else:
+        per_line = 0
+    log.debug("parsed %s lines (%s metrics) from %s in %.2fms (%.1fus/line)"
+              % (lines, metrics, file_name, elapsed * 1000, per_line))
+
+
+def parse_value(value):
+    """
+    parses a perfdata value like '12.5ms' into a tuple of (number, canonical
+    text, uom). The number is an int or float, or INVALID if the value isn't
+    a (finite) number.
+    """
+    match = VALUE_RE.match(value)
+    if match is None:
+        return (INVALID, value, '')
+    (number, uom) = match.groups()
+    try:
+        number = int(number)
+        text = str(number)
+    except ValueError:
+        number = float(number)
+        if number in (INFINITY, -INFINITY):
+            return (INVALID, value, uom)
+        text = repr(number)
+    return (number, text, uom)
+
+
+def parse_line(line):
+    """
+    parses one spool line into a list of GraphiosMetric objects, one per
+    perfdata label. Returns an empty list if the line isn't valid. Labels
+    whose value isn't a number are dropped and counted in invalid_values.
+    """
+    global invalid_values
+    header = get_mobj(line.rstrip("\r\n").split("\t"))
+    if not header:
+        return []
+    metrics = []
+    perfdata = header.PERFDATA
+    pos = 0
+    end = len(perfdata)
+    while pos < end:
+        match = PERFDATA_RE.match(perfdata, pos)
+        if match is None:
+            # skip the unparseable token, and carry on with the next one
+            bad = NOT_SPACE_RE.match(perfdata, pos)
+            if bad is None:
+                break
+            log.critical("failed to parse label: '%s' part of perf"
+                         "string '%s'" % (bad.group().strip(), perfdata))
+            pos = bad.end()
             continue
-        # log.debug('parsing: %s' % line)
-        graphite_lines += 1
-        variables = line.split('\t')
-        mobj = get_mobj(variables)
-        if mobj:
-            # break out the metric object into one object per perfdata metric
-            # log.debug('perfdata:%s' % mobj.PERFDATA)
-            for metric in mobj.PERFDATA.split():
-                try:
-                    nobj = copy.copy(mobj)
-                    (nobj.LABEL, d) = metric.split('=')
-                    v = d.split(';')[0]
-                    u = v
-                    nobj.VALUE = re.sub("[a-zA-Z%]", "", v)
-                    nobj.UOM = re.sub("[^a-zA-Z]+", "", u)
-                    processed_objects.append(nobj)
-                except:
-                    log.critical("failed to parse label: '%s' part of perf"
-                                 "string '%s'" % (metric, nobj.PERFDATA))
-                    continue
-    return processed_objects
+        pos = match.end()
+        label = match.group(1)
+        if label.startswith("'"):
+            label = LABEL_SPACE_RE.sub(cfg["replacement_character"],
+                                       label.translate(None, QUOTE_CHARS))
+        else:
+            label = label.translate(None, QUOTE_CHARS)
+        label = intern(label)
+        (number, text, uom) = parse_value(match.group(2))
+        if number is INVALID:
+            log.debug("dropping %s.%s, invalid value: '%s'" %
+                      (header.HOSTNAME, label, text))
+            invalid_values += 1
+            continue
+        metrics.append(GraphiosMetric(header, label, number, text, uom,
+                                      match.group(3)))
+    return metrics
 
 
 def get_mobj(nag_array):
     """
-        takes a split array of nagios variables and returns a mobj if it's
-        valid. otherwise return False.
+        takes a split array of nagios variables and returns a GraphiosCheck
+        if it's valid. otherwise return False.
     """
-    mobj = GraphiosMetric()
+    fields = {}
+    replacement = cfg["replacement_character"]
     for var in nag_array:
         # drop the metric if we can't split it for any reason
-        try:
-            (var_name, value) = var.split('::', 1)
-        except:
+        (var_name, sep, value) = var.partition('::')
+        if not sep:
             log.warn("could not split value %s, dropping metric" % var)
             return False
 
-        value = re.sub("/", cfg["replacement_character"], value)
-        if re.search("PERFDATA", var_name):
-            mobj.PERFDATA = value
-        elif re.search("^\$_", value):
+        value = value.replace("/", replacement)
+        if "PERFDATA" in var_name:
+            fields["PERFDATA"] = value
+        elif value.startswith("$_"):
             continue
         else:
-            value = re.sub("\s", "", value)
-            setattr(mobj, var_name, value)
-    mobj.validate()
-    if mobj.VALID is True:
-        return mobj
+            fields[var_name] = "".join(value.split())
+    header = GraphiosCheck(fields)
+    if header.VALID is True:
+        return header
     return False
 
 
@@ -438,16 +680,15 @@ def handle_file(file_name, graphite_lines):
             log.critical("couldn't remove file %s error:%s" % (file_name, ex))
         else:
             log.debug("deleted %s" % file_name)
+            remove_checkpoint(file_name)
 
 
 def process_spool_dir(directory):
     """
-    processes the files in the spool directory
+    processes the files in the spool directory, returns a tuple of (number of
+    files processed, number of files kept because a backend failed)
     """
-    global be
     log.debug("Processing spool directory %s", directory)
-    num_files = 0
-    mobjs_len = 0
     try:
         perfdata_files = os.listdir(directory)
     except (IOError, OSError) as e:
@@ -455,29 +696,611 @@ def process_spool_dir(directory):
         print "Check if dir exists, or file permissions."
         print "Exiting."
         sys.exit(1)
+    file_dirs = []
     for perfdata_file in perfdata_files:
-        mobjs = []
-        processed_dict = {}
-        all_done = True
         file_dir = os.path.join(directory, perfdata_file)
         if check_skip_file(perfdata_file, file_dir):
+            check_orphan_checkpoint(perfdata_file, perfdata_files, directory)
             continue
-        num_files += 1
-        mobjs = process_log(file_dir)
-        mobjs_len = len(mobjs)
-        processed_dict = send_backends(mobjs)
-        # process the output from the backends and decide the fate of the file
-        for backend in be["essential_backends"]:
-            if processed_dict[backend] < mobjs_len:
+        file_dirs.append(file_dir)
+    batch_size = cfg.get("stream_batch_size", 0)
+    pipeline = None
+    if cfg.get("parse_workers", 1) > 1 and len(file_dirs) > 1:
+        parsed_files = ((file_dir, unpack_batches(payload, batch_size))
+                        for (file_dir, payload) in parse_files(file_dirs))
+    elif cfg.get("pipeline_depth", 0) > 0 and file_dirs:
+        pipeline = SpoolPipeline(file_dirs, batch_size,
+                                 cfg["pipeline_depth"])
+        parsed_files = pipeline.files()
+    else:
+        parsed_files = ((file_dir, stream_log(file_dir, batch_size))
+                        for file_dir in file_dirs)
+    batcher = MetricBatcher(cfg.get("batch_max_metrics", 0),
+                            cfg.get("batch_max_bytes", 0),
+                            cfg.get("batch_max_age", 0))
+    for (file_dir, batches) in parsed_files:
+        batcher.start_file(file_dir)
+        for mobjs in batches:
+            # stop reading a file as soon as part of it failed, since it will
+            # be kept and retried anyway
+            if not batcher.add(file_dir, mobjs):
+                break
+        batcher.end_file(file_dir)
+    batcher.flush()
+    log.info("Processed %s files (%s metrics) in %s" % (batcher.num_files,
+             batcher.num_metrics, directory))
+    if pipeline is not None:
+        pipeline.log_depths()
+    return (batcher.num_files, batcher.num_kept)
+
+
+class MetricBatcher(object):
+    """
+    Gathers the metrics of many spool files and sends them to the backends
+    in one go, once max_metrics, max_bytes or max_age (seconds since the
+    first metric went in) is reached, so a busy nagios doesn't cost a set of
+    backend connections per (small) file. If all of those are 0 every add()
+    is sent on its own, which is one send per file (or per stream batch).
+
+    It keeps track of which part of which file is in a batch, and which
+    backends acknowledged it. A file is only handed to handle_file once it
+    was read completely and every essential backend processed all of it. A
+    file that is kept gets a checkpoint, so the next run only sends the
+    parts that are missing to the backends that are missing them.
+    """
+    def __init__(self, max_metrics, max_bytes, max_age):
+        self.max_metrics = max_metrics
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.coalesce = max_metrics > 0 or max_bytes > 0 or max_age > 0
+        self.files = {}  # file_dir -> state of the file, see start_file
+        self.num_files = 0
+        self.num_kept = 0
+        self.num_metrics = 0
+        self.reset()
+
+    def reset(self):
+        self.metrics = []
+        self.segments = []  # (file_dir, first metric index, metrics)
+        self.size = 0
+        self.started = None
+
+    def start_file(self, file_dir):
+        self.files[file_dir] = {
+            "metrics": 0,           # number of metrics read from the file
+            "read": False,          # the whole file was read
+            "batches": 0,           # unsent batches with metrics of the file
+            "acked": read_checkpoint(file_dir),  # backend -> [[start, end]]
+            "failed": set(),        # backends that failed part of the file
+        }
+
+    def end_file(self, file_dir):
+        self.files[file_dir]["read"] = True
+        self.check_file(file_dir)
+
+    def add(self, file_dir, mobjs):
+        """
+        adds metrics from file_dir to the batch, sending it whenever it is
+        full. Returns False once every backend failed part of file_dir, there
+        is no point reading the rest of it then.
+        """
+        state = self.files[file_dir]
+        while mobjs and len(state["failed"]) < len(be["enabled_backends"]):
+            if self.started is None:
+                self.started = time.time()
+            take = self.room(mobjs)
+            if not self.segments or self.segments[-1][0] != file_dir:
+                state["batches"] += 1
+            self.segments.append((file_dir, state["metrics"], mobjs[:take]))
+            self.metrics.extend(mobjs[:take])
+            state["metrics"] += take
+            mobjs = mobjs[take:]
+            if not self.coalesce or self.full():
+                self.flush()
+        return len(state["failed"]) < len(be["enabled_backends"])
+
+    def room(self, mobjs):
+        """
+        returns how many of mobjs fit in the batch (at least 1)
+        """
+        take = len(mobjs)
+        if self.max_metrics > 0:
+            take = min(take, self.max_metrics - len(self.metrics))
+        if self.max_bytes > 0:
+            header = None
+            for (i, m) in enumerate(mobjs[:take]):
+                if m.header is not header:
+                    header = m.header
+                    header_size = (len(header.METRICBASEPATH) +
+                                   len(header.GRAPHITEPREFIX) +
+                                   len(header.HOSTNAME) +
+                                   len(header.SERVICEDESC) +
+                                   len(header.GRAPHITEPOSTFIX) +
+                                   len(header.TIMET) + 8)
+                self.size += header_size + len(m.LABEL) + len(m.VALUETEXT)
+                if self.size >= self.max_bytes:
+                    take = i + 1
+                    break
+        return max(take, 1)
+
+    def full(self):
+        if self.max_metrics > 0 and len(self.metrics) >= self.max_metrics:
+            return True
+        if self.max_bytes > 0 and self.size >= self.max_bytes:
+            return True
+        if (
+            self.max_age > 0 and
+            time.time() - self.started >= self.max_age
+        ):
+            return True
+        return False
+
+    def backend_metrics(self):
+        """
+        returns a dict of the metrics each backend should get, for the
+        backends that shouldn't get all of them (because they already have
+        part of a file, or failed on a file earlier in this run)
+        """
+        ret = {}
+        for backend in be["enabled_backends"]:
+            special = False
+            for (file_dir, start, mobjs) in self.segments:
+                state = self.files[file_dir]
+                if backend in state["failed"] or backend in state["acked"]:
+                    special = True
+                    break
+            if not special:
+                continue
+            ret[backend] = []
+            for (file_dir, start, mobjs) in self.segments:
+                state = self.files[file_dir]
+                if backend not in state["failed"]:
+                    ret[backend].extend(
+                        unacked(mobjs, start, state["acked"].get(backend)))
+        return ret
+
+    def flush(self):
+        """
+        sends the batch to the backends and settles the files that were in it
+        """
+        if not self.metrics:
+            return
+        batch_files = []
+        for (file_dir, start, mobjs) in self.segments:
+            if not batch_files or batch_files[-1] != file_dir:
+                batch_files.append(file_dir)
+        if len(batch_files) == 1:
+            desc = batch_files[0]
+        else:
+            desc = "%s files (%s..%s)" % (len(batch_files), batch_files[0],
+                                          batch_files[-1])
+        log.debug("sending %s metrics from %s" % (len(self.metrics), desc))
+        backend_metrics = self.backend_metrics()
+        if be.get("queues"):
+            processed_dict = enqueue_backends(self.metrics, backend_metrics)
+        else:
+            processed_dict = send_backends(self.metrics, backend_metrics)
+        expected = {}
+        for backend in be["enabled_backends"]:
+            expected[backend] = len(backend_metrics.get(backend,
+                                                        self.metrics))
+        failed = check_processed(desc, processed_dict, expected)
+        segments = self.segments
+        self.reset()
+        for (file_dir, start, mobjs) in segments:
+            state = self.files[file_dir]
+            for backend in be["enabled_backends"]:
+                if backend in state["failed"]:
+                    continue
+                if backend in failed:
+                    state["failed"].add(backend)
+                else:
+                    state["acked"][backend] = add_range(
+                        state["acked"].get(backend, []), start,
+                        start + len(mobjs))
+        for file_dir in batch_files:
+            self.files[file_dir]["batches"] -= 1
+            self.check_file(file_dir)
+
+    def check_file(self, file_dir):
+        """
+        deletes (or keeps) file_dir once we know what happened to all of it
+        """
+        state = self.files[file_dir]
+        if not state["read"] or state["batches"] > 0:
+            return
+        del self.files[file_dir]
+        self.num_files += 1
+        self.num_metrics += state["metrics"]
+        if state["failed"].intersection(be["essential_backends"]):
+            self.num_kept += 1
+            write_checkpoint(file_dir, state["acked"])
+        else:
+            handle_file(file_dir, state["metrics"])
+
+
+def add_range(ranges, start, end):
+    """
+    adds [start, end) to a sorted list of non overlapping [start, end)
+    ranges, merging where they touch. Returns the new list.
+    """
+    ret = []
+    for (r_start, r_end) in ranges:
+        if r_end < start or r_start > end:
+            ret.append([r_start, r_end])
+        else:
+            start = min(start, r_start)
+            end = max(end, r_end)
+    ret.append([start, end])
+    ret.sort()
+    return ret
+
+
+def unacked(mobjs, start, ranges):
+    """
+    returns the metrics in mobjs (the first one being metric number start of
+    its file) that aren't in any of the acknowledged ranges
+    """
+    if not ranges:
+        return mobjs
+    ret = []
+    end = start + len(mobjs)
+    pos = start
+    for (r_start, r_end) in ranges:
+        if r_end <= pos or r_start >= end:
+            continue
+        if r_start > pos:
+            ret.extend(mobjs[pos - start:r_start - start])
+        pos = max(pos, r_end)
+    if pos < end:
+        ret.extend(mobjs[pos - start:])
+    return ret
+
+
+def checkpoint_name(file_dir):
+    """
+    returns the name of the checkpoint for a spool file, the leading _ makes
+    us (and the inotify watcher) skip it like any other _ file
+    """
+    (directory, file_name) = os.path.split(file_dir)
+    return os.path.join(directory, "_%s.ckpt" % file_name)
+
+
+def read_checkpoint(file_dir):
+    """
+    returns the acknowledged ranges per backend of a file that was kept
+    earlier, or an empty dict
+    """
+    if cfg.get("delivery_checkpoints", True) is not True:
+        return {}
+    try:
+        ckpt_file = open(checkpoint_name(file_dir), "r")
+    except (IOError, OSError):
+        return {}
+    try:
+        try:
+            checkpoint = json.load(ckpt_file)
+        finally:
+            ckpt_file.close()
+        if checkpoint["size"] != os.path.getsize(file_dir):
+            log.warning("ignoring checkpoint for %s, file changed" % file_dir)
+            return {}
+        acked = {}
+        for (backend, ranges) in checkpoint["backends"].iteritems():
+            acked[str(backend)] = ranges
+    except (IOError, OSError, ValueError, KeyError, TypeError) as ex:
+        log.warning("ignoring checkpoint for %s: %s" % (file_dir, ex))
+        return {}
+    log.debug("resuming %s from checkpoint %s" % (file_dir, acked))
+    return acked
+
+
+def write_checkpoint(file_dir, acked):
+    """
+    records which ranges of metrics of file_dir every backend acknowledged
+    """
+    if (
+        cfg.get("delivery_checkpoints", True) is not True or
+        cfg.get("test_mode") is True
+    ):
+        return
+    ckpt_name = checkpoint_name(file_dir)
+    tmp_name = "%s.tmp" % ckpt_name
+    try:
+        ckpt_file = open(tmp_name, "w")
+        try:
+            json.dump({"size": os.path.getsize(file_dir),
+                       "backends": acked}, ckpt_file)
+        finally:
+            ckpt_file.close()
+        os.rename(tmp_name, ckpt_name)
+    except (IOError, OSError) as ex:
+        log.warning("couldn't write checkpoint %s error:%s" % (ckpt_name, ex))
+
+
+def remove_checkpoint(file_dir):
+    """
+    removes the checkpoint of file_dir, if there is one
+    """
+    try:
+        os.remove(checkpoint_name(file_dir))
+    except (IOError, OSError):
+        pass
+    else:
+        log.debug("deleted checkpoint for %s" % file_dir)
+
+
+def check_orphan_checkpoint(file_name, perfdata_files, directory):
+    """
+    removes a checkpoint whose spool file is gone
+    """
+    if (
+        file_name.startswith("_") and
+        file_name.endswith(".ckpt") and
+        file_name[1:-5] not in perfdata_files
+    ):
+        remove_checkpoint(os.path.join(directory, file_name[1:-5]))
+
+
+class SpoolPipeline(object):
+    """
+    Runs reading and parsing of the spool files in their own threads, so
+    the cpu can parse while the dispatcher (process_spool_dir, in the main
+    thread) waits on the network, and the other way around.
+
+    reader -> read queue -> parser -> parse queue -> dispatcher
+
+    Both queues hold at most depth chunks (of lines, or of metrics), so when
+    the backends can't keep up the reader stalls instead of using up memory.
+    Queue depths are sampled by the dispatcher: a full parse queue means the
+    backends are the bottleneck, a full read queue with an empty parse
+    queue means parsing is.
+    """
+    READ_CHUNK = 65536  # bytes of lines the reader hands over at a time
+
+    def __init__(self, file_dirs, batch_size, depth):
+        self.file_dirs = file_dirs
+        self.batch_size = batch_size
+        self.depth = depth
+        self.read_q = Queue.Queue(depth)
+        self.parse_q = Queue.Queue(depth)
+        self.abandoned = set()  # files the dispatcher doesn't want anymore
+        self.depths = {"read": [0, 0, 0], "parse": [0, 0, 0]}  # n, sum, max
+        for (name, target) in (("reader", self.reader),
+                               ("parser", self.parser)):
+            thread = threading.Thread(target=self.run_stage,
+                                      args=(target,), name=name)
+            thread.daemon = True
+            thread.start()
+
+    def run_stage(self, target):
+        """
+        runs a stage, and makes sure the dispatcher hears about a crash
+        instead of waiting forever
+        """
+        try:
+            target()
+        except Exception as ex:
+            log.exception("pipeline %s died: %s" %
+                          (threading.current_thread().name, ex))
+            self.parse_q.put(("error", None, None))
+
+    def reader(self):
+        try:
+            self.read_files()
+        finally:
+            # whatever happened, the parser must not wait for more
+            self.read_q.put(("done", None, None))
+
+    def read_files(self):
+        for file_dir in self.file_dirs:
+            self.read_q.put(("start", file_dir, None))
+            try:
+                host_data_file = open(file_dir, "r")
+            except (IOError, OSError) as ex:
+                log.critical("Can't open file:%s error: %s" % (file_dir, ex))
+                self.read_q.put(("error", file_dir, None))
+                return
+            try:
+                while file_dir not in self.abandoned:
+                    lines = host_data_file.readlines(self.READ_CHUNK)
+                    if not lines:
+                        break
+                    self.read_q.put(("lines", file_dir, lines))
+            finally:
+                host_data_file.close()
+            self.read_q.put(("end", file_dir, None))
+
+    def parser(self):
+        global invalid_values
+        while True:
+            (kind, file_dir, lines) = self.read_q.get()
+            if kind == "start":
+                batch = []
+                graphite_lines = 0
+                num_metrics = 0
+                num_invalid = invalid_values
+                parse_time = 0.0
+                self.parse_q.put((kind, file_dir, None))
+            elif kind == "lines":
+                if file_dir in self.abandoned:
+                    continue
+                start = time.time()
+                for line in lines:
+                    if line.startswith("DATATYPE::"):
+                        graphite_lines += 1
+                        batch.extend(parse_line(line))
+                parse_time += time.time() - start
+                while self.batch_size > 0 and len(batch) >= self.batch_size:
+                    num_metrics += self.batch_size
+                    self.parse_q.put(("metrics", file_dir,
+                                      batch[:self.batch_size]))
+                    batch = batch[self.batch_size:]
+            elif kind == "end":
+                num_metrics += len(batch)
+                log_parse_cost(file_dir, graphite_lines, num_metrics,
+                               invalid_values - num_invalid, parse_time)
+                if batch:
+                    self.parse_q.put(("metrics", file_dir, batch))
+                batch = []
+                self.parse_q.put((kind, file_dir, None))
+            elif kind == "done":
+                return
+            else:
+                self.parse_q.put((kind, file_dir, None))
+
+    def get(self):
+        """
+        takes the next chunk off the parse queue (ctrl-c can't interrupt a
+        get() without a timeout)
+        """
+        for (name, q) in (("read", self.read_q), ("parse", self.parse_q)):
+            depth = q.qsize()
+            self.depths[name][0] += 1
+            self.depths[name][1] += depth
+            self.depths[name][2] = max(self.depths[name][2], depth)
+        while True:
+            try:
+                item = self.parse_q.get(True, 1)
+            except Queue.Empty:
+                continue
+            if item[0] == "error":
+                # process_log would have exited too
+                sys.exit(2)
+            return item
+
+    def files(self):
+        """
+        yields (file_dir, batches) for every file, like stream_log does
+        """
+        for file_dir in self.file_dirs:
+            (kind, item_file, data) = self.get()
+            self.done = False
+            yield (file_dir, self.batches(file_dir))
+            if not self.done:
+                # the dispatcher gave up on the file, skip the rest of it
+                self.abandoned.add(file_dir)
+                while not self.done:
+                    for batch in self.batches(file_dir):
+                        pass
+
+    def batches(self, file_dir):
+        while True:
+            (kind, item_file, data) = self.get()
+            if kind == "end":
+                self.done = True
+                return
+            yield data
+
+    def log_depths(self):
+        """
+        logs the average and max depth of the queues, to show where the
+        bottleneck is
+        """
+        stats = []
+        for name in ("read", "parse"):
+            (samples, total, peak) = self.depths[name]
+            if samples:
+                stats.append("%s queue avg %.1f max %s" %
+                             (name, float(total) / samples, peak))
+        log.info("pipeline (depth %s): %s" % (self.depth, ", ".join(stats)))
+
+
+def parse_files(file_dirs):
+    """
+    parses file_dirs in the parse_workers process pool, and yields a tuple of
+    (file_dir, pack_metrics() payload) for each of them in order, for
+    unpack_batches to build the metrics from. That still costs us (the one
+    process everything goes through) about a third of what parsing did,
+    which caps the speedup at about 3x. Scaling with the number of cores
+    would need the backends to work from the packed rows instead of
+    metric objects, that isn't done. Only a couple of files per
+    worker are parsed ahead of the one we are sending, so memory stays
+    bounded no matter how big the backlog is.
+    """
+    global invalid_values
+    init_parse_pool()
+    pending = collections.deque()
+    todo = iter(file_dirs)
+    for file_dir in todo:
+        pending.append((file_dir,
+                        parse_pool.apply_async(parse_file, (file_dir,))))
+        if len(pending) >= cfg["parse_workers"] * 2:
+            break
+    while pending:
+        (file_dir, result) = pending.popleft()
+        for next_file in todo:
+            pending.append((next_file,
+                            parse_pool.apply_async(parse_file, (next_file,))))
+            break
+        # a plain get() can't be interrupted with ctrl-c
+        try:
+            parsed = result.get(parse_timeout)
+        except multiprocessing.TimeoutError:
+            log.critical("parse worker took over %ss on %s, giving up" %
+                         (parse_timeout, file_dir))
+            sys.exit(2)
+        if parsed is None:
+            # the worker already logged why
+            sys.exit(2)
+        (payload, invalid) = parsed
+        invalid_values += invalid
+        yield (file_dir, payload)
+
+
+def init_parse_pool():
+    """
+    starts the parse_workers process pool. This forks, so it has to happen
+    before any of our threads (backend workers, queue drainers, librato's
+    flush pool) run: a lock one of them holds, eg. in logging, would stay
+    locked forever in the workers.
+    """
+    global parse_pool
+    if parse_pool is None and cfg.get("parse_workers", 1) > 1:
+        log.info("starting %s parse workers" % cfg["parse_workers"])
+        parse_pool = multiprocessing.Pool(cfg["parse_workers"],
+                                          init_parse_worker)
+
+
+def init_parse_worker():
+    """
+    runs in every parse worker, ctrl-c is handled by the main process
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def parse_file(file_name):
+    """
+    runs in a parse worker, returns a tuple of (pack_metrics() payload,
+    number of invalid values dropped) for file_name, or None if the file
+    couldn't be read
+    """
+    invalid = invalid_values
+    try:
+        mobjs = process_log(file_name)
+    except SystemExit:
+        return None
+    return (pack_metrics(mobjs), invalid_values - invalid)
+
+
+def check_processed(desc, processed_dict, expected):
+    """
+    process the output from the backends and decide the fate of the files
+    in desc. expected is a dict of how many metrics each backend should have
+    processed. Returns the set of backends that processed less than that.
+    """
+    global be
+    failed = set()
+    for backend in be["enabled_backends"]:
+        if processed_dict.get(backend, 0) < expected[backend]:
+            failed.add(backend)
+            if backend in be["essential_backends"]:
                 log.critical("keeping %s, insufficent metrics sent from %s. \
-                             Should be %s, got %s" % (file_dir, backend,
-                                                      mobjs_len,
-                                                      processed_dict[backend]))
-                all_done = False
-        if all_done is True:
-            handle_file(file_dir, len(mobjs))
-    log.info("Processed %s files (%s metrics) in %s" % (num_files,
-             mobjs_len, directory))
+                             Should be %s, got %s" % (desc, backend,
+                                                      expected[backend],
+                                                      processed_dict.get(
+                                                          backend, 0)))
+    return failed
 
 
 def check_skip_file(file_name, file_dir):
@@ -516,6 +1339,7 @@ def init_backends():
     be["enabled_backends"] = {}  # a dict of instantiated backend objects
     be["essential_backends"] = []  # a list of backends we actually care about
     # PLUGIN WRITERS! register your new backends by adding their obj name here
+    backends.resolver.configure(cfg)
     avail_backends = ("carbon",
                       "statsd",
                       "librato",
@@ -539,34 +1363,710 @@ def init_backends():
                 be["essential_backends"].append(backend)
     # not proud of that slovenly conditional ^^
     log.info("Enabled backends: %s" % be["enabled_backends"].keys())
+    be["breakers"] = {}
+    if cfg.get("breaker_failures", 3) > 0:
+        for backend in be["enabled_backends"]:
+            be["breakers"][backend] = CircuitBreaker(
+                backend, cfg.get("breaker_failures", 3),
+                cfg.get("breaker_backoff", 15),
+                cfg.get("breaker_backoff_max", 480))
+    be["workers"] = {}
+    if (cfg.get("concurrent_backends", True) is True and
+            len(be["enabled_backends"]) > 1):
+        for (backend, backend_obj) in be["enabled_backends"].items():
+            be["workers"][backend] = BackendWorker(backend, backend_obj)
+            be["workers"][backend].start()
 
 
-def send_backends(metrics):
+class CircuitBreaker(object):
     """
-    use the enabled_backends dict to call into the backend send functions
+    Stops sending to a backend that keeps failing. After failures failed
+    sends in a row the circuit opens and the backend is skipped (its files
+    stay pending) for backoff seconds. Then one batch is let through to
+    probe it (half open): if that works the circuit closes, if not it opens
+    again for twice as long, up to backoff_max seconds.
+    """
+    def __init__(self, name, failures, backoff, backoff_max):
+        self.name = name
+        self.failures = failures
+        self.backoff_min = max(backoff, 1)
+        self.backoff_max = max(backoff_max, self.backoff_min)
+        self.state = "closed"
+        self.failed = 0
+        self.backoff = 0
+        self.open_until = 0
+
+    def allow(self):
+        """
+        True if the backend should get the next batch
+        """
+        if self.state == "closed":
+            return True
+        if self.state == "open" and time.time() >= self.open_until:
+            log.info("circuit for %s is half open, probing it" % self.name)
+            self.state = "half open"
+            return True
+        if self.state == "open":
+            log.info("skipping %s, circuit open for another %.0fs" % (
+                     self.name, self.open_until - time.time()))
+        return False
+
+    def record(self, ok):
+        """
+        records how the last batch we allowed went
+        """
+        if ok:
+            if self.state != "closed":
+                log.info("circuit for %s is closed again" % self.name)
+            self.state = "closed"
+            self.failed = 0
+            self.backoff = 0
+            return
+        self.failed += 1
+        if self.state == "half open":
+            self.backoff = min(self.backoff * 2, self.backoff_max)
+        elif self.failed >= self.failures:
+            self.backoff = self.backoff_min
+        else:
+            return
+        self.state = "open"
+        self.open_until = time.time() + self.backoff
+        log.warning("circuit for %s is open after %s failures, skipping it "
+                    "for %ss" % (self.name, self.failed, self.backoff))
+
+
+def breaker_allows(backend):
+    breaker = be.get("breakers", {}).get(backend)
+    return breaker is None or breaker.allow()
+
+
+def breaker_record(backend, processed, expected):
+    breaker = be.get("breakers", {}).get(backend)
+    if breaker is not None:
+        breaker.record(processed >= expected)
+
+
+class BackendWorker(threading.Thread):
+    """
+    Calls one backend's send() in its own thread, so send_backends can send
+    a batch to every backend at the same time and only waits for the
+    slowest one (or backend_deadline).
+    """
+    def __init__(self, name, backend):
+        threading.Thread.__init__(self, name="send-%s" % name)
+        self.daemon = True
+        self.backend = backend
+        self.jobs = Queue.Queue(1)
+        self.busy = False
+
+    def submit(self, metrics):
+        """
+        hands metrics to the backend, returns the (not yet done) result
+        """
+        result = {"done": threading.Event(), "processed": 0}
+        self.busy = True
+        self.jobs.put((metrics, result))
+        return result
+
+    def run(self):
+        while True:
+            (metrics, result) = self.jobs.get()
+            try:
+                result["processed"] = self.backend.send(metrics)
+            except Exception as ex:
+                log.exception("%s failed: %s" % (self.name, ex))
+            self.busy = False
+            result["done"].set()
+
+
+def send_backends(metrics, backend_metrics=None):
+    """
+    use the enabled_backends dict to call into the backend send functions.
+    backend_metrics can map backend names to the metrics that backend should
+    get instead of metrics, backends with nothing to send aren't called.
     """
     global be
     if len(be["enabled_backends"]) < 1:
         log.critical("At least one Back-end must be enabled in graphios.cfg")
         sys.exit(1)
+    if be.get("workers"):
+        return send_backends_concurrently(metrics, backend_metrics)
     ret = {}  # return a dict of who processed what
     processed_lines = 0
     for backend in be["enabled_backends"]:
-        processed_lines = be["enabled_backends"][backend].send(metrics)
+        mlist = metrics
+        if backend_metrics and backend in backend_metrics:
+            mlist = backend_metrics[backend]
+        if not mlist or not breaker_allows(backend):
+            ret[backend] = 0
+            continue
+        processed_lines = be["enabled_backends"][backend].send(mlist)
+        breaker_record(backend, processed_lines, len(mlist))
         # log.debug('%s processed %s metrics' % backend, processed_lines)
         ret[backend] = processed_lines
     return ret
 
 
+def send_backends_concurrently(metrics, backend_metrics=None):
+    """
+    send_backends, with every backend sending from its own BackendWorker at
+    the same time. A backend that isn't done by backend_deadline seconds
+    (if set) counts as having processed nothing, and gets no new batches
+    until it is done with that one.
+    """
+    global be
+    ret = {}
+    results = {}
+    for (backend, worker) in be["workers"].items():
+        mlist = metrics
+        if backend_metrics and backend in backend_metrics:
+            mlist = backend_metrics[backend]
+        if not mlist:
+            ret[backend] = 0
+        elif worker.busy:
+            # before asking the breaker, a half open probe we let through
+            # has to actually be sent (and recorded)
+            log.warning("%s is still sending an earlier batch, skipping it"
+                        % backend)
+            ret[backend] = 0
+        elif not breaker_allows(backend):
+            ret[backend] = 0
+        else:
+            results[backend] = (worker.submit(mlist), len(mlist))
+    deadline = None
+    if cfg.get("backend_deadline", 0) > 0:
+        deadline = time.time() + cfg["backend_deadline"]
+    for (backend, (result, expected)) in results.items():
+        while not result["done"].is_set():
+            # waiting in short steps keeps ctrl-c working
+            wait = 1
+            if deadline is not None:
+                wait = min(wait, deadline - time.time())
+                if wait <= 0:
+                    break
+            result["done"].wait(wait)
+        if result["done"].is_set():
+            ret[backend] = result["processed"]
+        else:
+            log.warning("%s missed the %ss deadline" % (
+                        backend, cfg["backend_deadline"]))
+            ret[backend] = 0
+        breaker_record(backend, ret[backend], expected)
+    return ret
+
+
+def pack_metrics(mobjs):
+    """
+    serializes a list of metrics for a BackendQueue. Every GraphiosCheck is
+    only stored once, no matter how many labels point at it.
+    """
+    headers = []
+    header_index = {}
+    rows = []
+    for m in mobjs:
+        i = header_index.get(id(m.header))
+        if i is None:
+            i = header_index[id(m.header)] = len(headers)
+            headers.append(tuple([getattr(m.header, name)
+                                  for name in GraphiosCheck.__slots__]))
+        rows.append((i, m.LABEL, m.VALUE, m.VALUETEXT, m.UOM,
+                     m.THRESHOLDS))
+    return pickle.dumps((GraphiosCheck.__slots__, headers, rows), 2)
+
+
+def unpack_metrics(payload):
+    """
+    turns what pack_metrics made back into a list of metrics
+    """
+    metrics = []
+    for batch in unpack_batches(payload, 0):
+        metrics.extend(batch)
+    return metrics
+
+
+def unpack_batches(payload, batch_size):
+    """
+    turns what pack_metrics made back into metrics, and yields them in
+    batch_size sized lists (or all at once if batch_size is 0). A batch is
+    only built when it's asked for, so nothing is built for the rest of a
+    file the dispatcher gave up on.
+    """
+    (names, headers, rows) = pickle.loads(payload)
+    if tuple(names) != GraphiosCheck.__slots__:
+        # written by a graphios with different header fields
+        default = {'METRICTYPE': 'gauge', 'VALID': True, 'EXTRA': {}}
+        headers = [[dict(zip(names, h)).get(name, default.get(name, ''))
+                    for name in GraphiosCheck.__slots__] for h in headers]
+    if batch_size <= 0:
+        batch_size = max(len(rows), 1)
+    restored = {}
+    for start in xrange(0, len(rows), batch_size):
+        batch = []
+        for row in rows[start:start + batch_size]:
+            header = restored.get(row[0])
+            if header is None:
+                header = restored[row[0]] = restore_check(headers[row[0]])
+            # rows written before thresholds were kept have one field less
+            batch.append(GraphiosMetric(header, *row[1:]))
+        yield batch
+
+
+class BackendQueue(object):
+    """
+    A durable, append-only queue of metric batches for one backend, so every
+    backend can be fed at its own pace and spool files can be deleted as soon
+    as their metrics are safely on disk.
+
+    Records (a length, a crc32 and a pack_metrics() payload) are appended to
+    numbered segment files in directory. The position up to which the
+    backend acknowledged everything is kept in the 'ack' file, and segments
+    before it are deleted (compacted) as the backend catches up. When the
+    queue grows past max_bytes the oldest segments are dropped.
+    """
+    RECORD = struct.Struct("!II")
+
+    def __init__(self, directory, segment_bytes, max_bytes, fsync):
+        self.log = logging.getLogger("log.queue.%s" %
+                                     os.path.basename(directory))
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.max_bytes = max_bytes
+        self.fsync = fsync
+        self.cond = threading.Condition()
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.segments = sorted([int(f[:-4]) for f in os.listdir(directory)
+                                if f.endswith(".seg")])
+        self.sizes = dict([(seg, os.path.getsize(self.segment_name(seg)))
+                           for seg in self.segments])
+        (self.read_seg, self.read_pos) = self.load_ack()
+        for seg in [s for s in self.segments if s < self.read_seg]:
+            self.remove_segment(seg)
+        # always write to a new segment, the last one may have a torn record
+        self.writer = None
+        self.write_seg = 0
+        if self.segments:
+            self.write_seg = self.segments[-1]
+        self.roll()
+        if self.read_seg not in self.segments:
+            (self.read_seg, self.read_pos) = (self.segments[0], 0)
+        self.reader = None
+        self.reader_seg = None
+
+    def segment_name(self, seg):
+        return os.path.join(self.directory, "%016d.seg" % seg)
+
+    def load_ack(self):
+        try:
+            ack_file = open(os.path.join(self.directory, "ack"), "r")
+            try:
+                (seg, pos) = ack_file.read().split()
+            finally:
+                ack_file.close()
+            return (int(seg), int(pos))
+        except (IOError, OSError, ValueError):
+            return (0, 0)
+
+    def size(self):
+        return sum(self.sizes.values())
+
+    def roll(self):
+        """
+        starts a new segment to write to
+        """
+        if self.writer is not None:
+            self.sync()
+            self.writer.close()
+        self.write_seg += 1
+        self.writer = open(self.segment_name(self.write_seg), "ab")
+        self.segments.append(self.write_seg)
+        self.sizes[self.write_seg] = 0
+        if self.fsync:
+            # make sure the new file itself survives a crash
+            dir_fd = os.open(self.directory, os.O_RDONLY)
+            try:
+                os.fsync(dir_fd)
+            finally:
+                os.close(dir_fd)
+
+    def sync(self):
+        self.writer.flush()
+        if self.fsync:
+            os.fsync(self.writer.fileno())
+
+    def put(self, payload):
+        """
+        appends a record to the queue, it is durable once commit() returns
+        """
+        record = self.RECORD.pack(len(payload),
+                                  zlib.crc32(payload) & 0xffffffff)
+        self.cond.acquire()
+        try:
+            if self.sizes[self.write_seg] >= self.segment_bytes:
+                self.roll()
+            self.writer.write(record)
+            self.writer.write(payload)
+            self.writer.flush()
+            self.sizes[self.write_seg] += len(record) + len(payload)
+            self.enforce_max_bytes()
+            self.cond.notify_all()
+        finally:
+            self.cond.release()
+
+    def commit(self):
+        """
+        fsyncs the records put() since the last commit, so put() all of a
+        batch first and commit once
+        """
+        self.cond.acquire()
+        try:
+            self.sync()
+        finally:
+            self.cond.release()
+
+    def enforce_max_bytes(self):
+        while self.size() > self.max_bytes and len(self.segments) > 1:
+            seg = self.segments[0]
+            self.log.critical("queue %s is over %s bytes, dropping %s bytes "
+                              "of undelivered metrics" %
+                              (self.directory, self.max_bytes,
+                               self.sizes[seg]))
+            if seg == self.reader_seg:
+                self.close_reader()
+            if seg == self.read_seg:
+                (self.read_seg, self.read_pos) = (self.segments[1], 0)
+                self.save_ack()
+            self.remove_segment(seg)
+
+    def remove_segment(self, seg):
+        try:
+            os.remove(self.segment_name(seg))
+        except (IOError, OSError) as ex:
+            self.log.warning("couldn't remove %s error:%s" %
+                             (self.segment_name(seg), ex))
+        self.segments.remove(seg)
+        del self.sizes[seg]
+
+    def close_reader(self):
+        if self.reader is not None:
+            self.reader.close()
+            self.reader = None
+
+    def read(self, max_metrics, timeout):
+        """
+        returns a tuple of (metrics, position) with the metrics of the
+        records after the acknowledged position (up to about max_metrics of
+        them), and the position to ack() once the backend has them. Waits up
+        to timeout seconds for something to show up.
+        """
+        self.cond.acquire()
+        try:
+            metrics = []
+            (seg, pos) = (self.read_seg, self.read_pos)
+            while len(metrics) < max_metrics:
+                payload = self.read_record(seg, pos)
+                if payload is None:
+                    # end of this segment, carry on with the next one
+                    later = [s for s in self.segments if s > seg]
+                    if not later:
+                        if not metrics and timeout > 0:
+                            self.cond.wait(timeout)
+                            timeout = 0
+                            continue
+                        break
+                    (seg, pos) = (later[0], 0)
+                    continue
+                metrics.extend(unpack_metrics(payload))
+                pos += self.RECORD.size + len(payload)
+            return (metrics, (seg, pos))
+        finally:
+            self.cond.release()
+
+    def read_record(self, seg, pos):
+        """
+        returns the payload of the record at pos in segment seg, or None at
+        the end of the segment (or at a torn record)
+        """
+        if self.reader is None or self.reader_seg != seg:
+            self.close_reader()
+            try:
+                self.reader = open(self.segment_name(seg), "rb")
+            except (IOError, OSError):
+                return None
+            self.reader_seg = seg
+        self.reader.seek(pos)
+        header = self.reader.read(self.RECORD.size)
+        if len(header) < self.RECORD.size:
+            return None
+        (length, crc) = self.RECORD.unpack(header)
+        payload = self.reader.read(length)
+        if (
+            len(payload) < length or
+            zlib.crc32(payload) & 0xffffffff != crc
+        ):
+            if seg != self.write_seg:
+                self.log.warning("skipping torn record at %s:%s" %
+                                 (self.segment_name(seg), pos))
+            return None
+        return payload
+
+    def ack(self, position):
+        """
+        the backend has everything up to position, compact what it's done
+        """
+        self.cond.acquire()
+        try:
+            (self.read_seg, self.read_pos) = position
+            self.save_ack()
+            for seg in [s for s in self.segments if s < self.read_seg]:
+                if seg == self.reader_seg:
+                    self.close_reader()
+                self.remove_segment(seg)
+        finally:
+            self.cond.release()
+
+    def save_ack(self):
+        ack_name = os.path.join(self.directory, "ack")
+        ack_file = open("%s.tmp" % ack_name, "w")
+        try:
+            ack_file.write("%s %s\n" % (self.read_seg, self.read_pos))
+        finally:
+            ack_file.close()
+        os.rename("%s.tmp" % ack_name, ack_name)
+
+
+class QueueDrainer(threading.Thread):
+    """
+    Feeds one backend from its BackendQueue, at whatever pace that backend
+    can take. Backs off (up to sleep_max) while the backend fails.
+    """
+    def __init__(self, name, backend, queue):
+        threading.Thread.__init__(self, name="drain-%s" % name)
+        self.daemon = True
+        self.backend_name = name
+        self.backend = backend
+        self.queue = queue
+        self.stopping = threading.Event()
+
+    def stop(self):
+        self.stopping.set()
+        self.queue.cond.acquire()
+        self.queue.cond.notify_all()
+        self.queue.cond.release()
+        self.join(float(cfg["sleep_time"]))
+
+    def run(self):
+        sleep_time = float(cfg["sleep_time"])
+        sleep = sleep_time
+        while not self.stopping.is_set():
+            (metrics, position) = self.queue.read(cfg["queue_drain_metrics"],
+                                                  sleep_time)
+            if not metrics:
+                if position != (self.queue.read_seg, self.queue.read_pos):
+                    # only skipped over empty/torn segments
+                    self.queue.ack(position)
+                continue
+            try:
+                sent = self.backend.send(metrics)
+            except Exception as ex:
+                log.exception("%s backend failed: %s" % (self.backend_name,
+                                                         ex))
+                sent = 0
+            if sent >= len(metrics):
+                self.queue.ack(position)
+                sleep = sleep_time
+            else:
+                log.warning("%s only processed %s of %s queued metrics, "
+                            "retrying in %ss" % (self.backend_name, sent,
+                                                 len(metrics), sleep))
+                self.stopping.wait(sleep)
+                sleep = min(sleep * 2, float(cfg["sleep_max"]))
+
+
+def init_queues():
+    """
+    if queue_directory is set, gives every enabled backend its own
+    BackendQueue and a QueueDrainer thread. process_spool_dir then only
+    enqueues, and deletes spool files as soon as they are on disk.
+    """
+    global be
+    be["queues"] = {}
+    be["drainers"] = []
+    if not cfg.get("queue_directory"):
+        return
+    for backend in be["enabled_backends"]:
+        try:
+            queue = BackendQueue(os.path.join(cfg["queue_directory"],
+                                              backend),
+                                 cfg["queue_segment_bytes"],
+                                 cfg["queue_max_bytes"],
+                                 cfg.get("queue_fsync", True) is True)
+        except (IOError, OSError) as ex:
+            log.critical("Can't open queue for %s in %s error: %s" %
+                         (backend, cfg["queue_directory"], ex))
+            sys.exit(1)
+        be["queues"][backend] = queue
+        be["drainers"].append(QueueDrainer(backend,
+                                           be["enabled_backends"][backend],
+                                           queue))
+        be["drainers"][-1].start()
+    log.info("Queueing metrics for %s in %s" % (be["queues"].keys(),
+                                                cfg["queue_directory"]))
+
+
+def stop_queues():
+    """
+    stops the QueueDrainer threads, anything they didn't ack stays queued
+    """
+    for drainer in be.get("drainers", []):
+        drainer.stop()
+
+
+def enqueue_backends(metrics, backend_metrics=None):
+    """
+    the queue_directory version of send_backends, puts the metrics in the
+    queue of every backend and returns a dict of who queued what. Every queue
+    is committed (fsynced) once, after all the puts and before anybody
+    deletes the spool files.
+    """
+    global be
+    ret = {}
+    payload = None
+    queued = []
+    for backend in be["queues"]:
+        mlist = metrics
+        if backend_metrics and backend in backend_metrics:
+            mlist = backend_metrics[backend]
+        if not mlist:
+            ret[backend] = 0
+            continue
+        try:
+            if mlist is metrics:
+                if payload is None:
+                    payload = pack_metrics(metrics)
+                be["queues"][backend].put(payload)
+            else:
+                be["queues"][backend].put(pack_metrics(mlist))
+        except (IOError, OSError) as ex:
+            log.critical("Can't queue metrics for %s error: %s" % (backend,
+                                                                   ex))
+            ret[backend] = 0
+        else:
+            ret[backend] = len(mlist)
+            queued.append(backend)
+    for backend in queued:
+        try:
+            be["queues"][backend].commit()
+        except (IOError, OSError) as ex:
+            log.critical("Can't commit the queue of %s error: %s" % (backend,
+                                                                     ex))
+            ret[backend] = 0
+    return ret
+
+
+class SpoolWatcher(object):
+    """
+    Watches the spool directory with linux inotify (through ctypes, so we
+    don't need any extra modules) to wake graphios up as soon as nagios moves
+    a perfdata file in, instead of waiting for the next sleep_time.
+    """
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_TO = 0x00000080
+    IN_Q_OVERFLOW = 0x00004000
+    EVENT = struct.Struct("iIII")  # wd, mask, cookie, len (then the name)
+
+    def __init__(self, directory):
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.fd = libc.inotify_init()
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init failed")
+        wd = libc.inotify_add_watch(self.fd, directory,
+                                    self.IN_CLOSE_WRITE | self.IN_MOVED_TO)
+        if wd < 0:
+            errno = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(errno, "inotify_add_watch failed on %s" % directory)
+
+    def wait(self, timeout):
+        """
+        waits at most timeout seconds for a new perfdata file, returns True
+        if one showed up
+        """
+        deadline = time.time() + timeout
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return False
+            try:
+                (ready, _, _) = select.select([self.fd], [], [], remaining)
+            except select.error:
+                # interrupted by a signal
+                continue
+            if not ready:
+                return False
+            if self.new_perfdata(os.read(self.fd, 65536)):
+                return True
+
+    def new_perfdata(self, data):
+        """
+        returns True if data has an event for a file we should process
+        """
+        pos = 0
+        while pos + self.EVENT.size <= len(data):
+            (wd, mask, cookie, length) = self.EVENT.unpack_from(data, pos)
+            pos += self.EVENT.size
+            name = data[pos:pos + length].rstrip("\0")
+            pos += length
+            if mask & self.IN_Q_OVERFLOW:
+                return True
+            if (
+                name != "host-perfdata" and
+                name != "service-perfdata" and
+                not name.startswith("_")
+            ):
+                return True
+        return False
+
+
+def init_watcher(directory):
+    """
+    returns a SpoolWatcher for directory, or None if we have to poll
+    """
+    try:
+        watcher = SpoolWatcher(directory)
+    except (AttributeError, OSError, TypeError) as ex:
+        log.info("inotify isn't available (%s), polling %s" % (ex, directory))
+        return None
+    log.info("watching %s with inotify" % directory)
+    return watcher
+
+
 def main():
     log.info("graphios startup.")
+    watcher = None
+    if cfg.get("spool_watch", True) is True:
+        watcher = init_watcher(spool_directory)
+    sleep_time = float(cfg["sleep_time"])
+    sleep_max = float(cfg["sleep_max"])
+    sleep = sleep_time
     try:
         while True:
-            process_spool_dir(spool_directory)
-            log.debug("graphios sleeping.")
-            time.sleep(float(cfg["sleep_time"]))
+            (num_files, num_kept) = process_spool_dir(spool_directory)
+            # back off while the backends are failing, or (if we are
+            # polling) while there is nothing to do
+            if num_kept > 0 or (num_files == 0 and watcher is None):
+                sleep = min(sleep * 2, sleep_max)
+            else:
+                sleep = sleep_time
+            if watcher is not None and num_kept == 0:
+                log.debug("graphios waiting for perfdata.")
+                watcher.wait(sleep_max)
+            else:
+                log.debug("graphios sleeping %ss." % sleep)
+                time.sleep(sleep)
     except KeyboardInterrupt:
         log.info("ctrl-c pressed. Exiting graphios.")
+        stop_queues()
 
 
 if __name__ == '__main__':
@@ -582,5 +2082,7 @@ if __name__ == '__main__':
     verify_config(cfg)
     configure()
     # print cfg
+    init_parse_pool()
     init_backends()
+    init_queues()
     main()
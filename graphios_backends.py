@@ -2,15 +2,607 @@
 
 import socket
 import cPickle as pickle
+import cStringIO
 import struct
 import re
 import logging
 import sys
 import base64
-import urllib2
+import collections
+import bisect
+import errno
+import hashlib
+import httplib
+import itertools
 import json
+import multiprocessing.pool
 import os
 import ast
+import operator
+import random
+import select
+import string
+import threading
+import time
+import urlparse
+import zlib
+
+# ###########################################################
+# #### metric naming (shared by the backends)
+
+log = logging.getLogger("log.backends")
+
+# chars carbon can't have in a metric name, whitespace is replaced as well
+CARBON_INVALID_CHARS = '~!$:;%^*()+={}[]|\\/<>' + string.whitespace
+# newest pickle protocol carbon's pickle receiver (python 2) can read
+CARBON_PICKLE_PROTOCOL = 2
+DOTS_RE = re.compile(r"\.{2,}")
+# influxdb line protocol escaping, for measurements and tag keys/values
+MEASUREMENT_ESCAPE_RE = re.compile(r"([, ])")
+TAG_ESCAPE_RE = re.compile(r"([,= ])")
+
+
+class LRUCache(object):
+    """
+    A dict with a maximum size that throws away the least recently used key
+    when it's full. Counts hits and misses.
+    """
+    # fields of the circular doubly linked list that keeps the usage order
+    PREV, NEXT, KEY, VALUE = 0, 1, 2, 3
+
+    def __init__(self, size):
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self.map = {}
+        self.root = []
+        self.root[:] = [self.root, self.root, None, None]
+
+    def __len__(self):
+        return len(self.map)
+
+    def get(self, key, default=None):
+        link = self.map.get(key)
+        if link is None:
+            self.misses += 1
+            return default
+        self.hits += 1
+        # move the link to the front (most recently used)
+        (link_prev, link_next) = link[0:2]
+        link_prev[self.NEXT] = link_next
+        link_next[self.PREV] = link_prev
+        last = self.root[self.PREV]
+        last[self.NEXT] = self.root[self.PREV] = link
+        link[self.PREV] = last
+        link[self.NEXT] = self.root
+        return link[self.VALUE]
+
+    def put(self, key, value):
+        if self.size <= 0:
+            return
+        link = self.map.get(key)
+        if link is not None:
+            link[self.VALUE] = value
+            return
+        if len(self.map) >= self.size:
+            # recycle the oldest link
+            oldest = self.root[self.NEXT]
+            oldest[self.PREV][self.NEXT] = oldest[self.NEXT]
+            oldest[self.NEXT][self.PREV] = oldest[self.PREV]
+            del self.map[oldest[self.KEY]]
+        last = self.root[self.PREV]
+        link = [last, self.root, key, value]
+        last[self.NEXT] = self.root[self.PREV] = self.map[key] = link
+
+    def clear(self):
+        self.map.clear()
+        self.root[:] = [self.root, self.root, None, None]
+
+    def stats(self):
+        return "%s hits, %s misses, %s/%s entries" % (self.hits, self.misses,
+                                                      len(self.map), self.size)
+
+
+class MetricNamer(object):
+    """
+    Builds metric paths for a backend. fields is the list of metric
+    attributes that make up the path, in order. Empty parts are skipped,
+    the rest are joined with dots and invalid_chars are replaced with the
+    replacement string in a single translate() pass. Host/service/label
+    combinations hardly change between runs, so paths are kept in an LRU
+    cache keyed on the values of those fields.
+    """
+    def __init__(self, cfg, fields, invalid_chars='', replacement=None):
+        if replacement is None:
+            replacement = cfg.get('replacement_character', '_')
+        try:
+            cache_size = int(cfg.get('naming_cache_size', 20000))
+        except ValueError:
+            log.critical("naming_cache_size needs to be a integer")
+            sys.exit(1)
+        self.fields = fields
+        self.getter = operator.attrgetter(*fields)
+        self.cache = LRUCache(cache_size)
+        self.sanitize = self.compile_sanitizer(invalid_chars, replacement)
+
+    def compile_sanitizer(self, invalid_chars, replacement):
+        """
+        returns a function that replaces every char in invalid_chars
+        """
+        if not invalid_chars:
+            return None
+        if len(replacement) == 1:
+            table = string.maketrans(invalid_chars,
+                                     replacement * len(invalid_chars))
+            return lambda s: s.translate(table)
+        # translate() can only do single chars
+        invalid_re = re.compile("[%s]" % re.escape(invalid_chars))
+        return lambda s: invalid_re.sub(replacement, s)
+
+    def build(self, parts):
+        """
+        Builds the path from the field values, uncached
+        """
+        if len(self.fields) == 1:
+            parts = (parts,)
+        path = ".".join([p for p in parts if p])
+        if ".." in path or path.startswith(".") or path.endswith("."):
+            path = DOTS_RE.sub(".", path).strip(".")
+        if self.sanitize is not None:
+            path = self.sanitize(path)
+        return path
+
+    def path(self, m):
+        """
+        Returns the path for metric m
+        """
+        key = self.getter(m)
+        path = self.cache.get(key)
+        if path is None:
+            path = self.build(key)
+            self.cache.put(key, path)
+        return path
+
+
+# ###########################################################
+# #### name resolution (shared by the backends)
+
+class Resolver(object):
+    """
+    Caches name lookups for every backend, so a slow or flaky dns server
+    doesn't hold up each send. Addresses are kept for ttl seconds and failed
+    lookups for negative_ttl seconds. When a lookup of a name we resolved
+    before fails, the last address we got for it is used until the next
+    try.
+    """
+    def __init__(self, ttl=300.0, negative_ttl=30.0):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.lock = threading.Lock()
+        self.cache = {}  # name: (address or None, expires, last good address)
+        self.hits = 0
+        self.misses = 0
+        self.failures = 0
+
+    def configure(self, cfg):
+        self.ttl = get_float_option(cfg, 'dns_cache_ttl', 300, log)
+        self.negative_ttl = get_float_option(cfg, 'dns_negative_ttl', 30,
+                                             log)
+        with self.lock:
+            self.cache.clear()
+
+    def resolve(self, name):
+        """
+        Returns the ipv4 address of name, raises socket.gaierror if there
+        isn't one
+        """
+        now = time.time()
+        with self.lock:
+            entry = self.cache.get(name)
+            if entry is not None and now < entry[1]:
+                self.hits += 1
+                if entry[0] is None:
+                    raise socket.gaierror("can't resolve %s (cached)" % name)
+                return entry[0]
+            self.misses += 1
+        last_good = entry and entry[2]
+        try:
+            address = socket.gethostbyname(name)
+        except socket.error, ex:
+            with self.lock:
+                self.failures += 1
+                if last_good:
+                    log.warning("Can't resolve %s: %s, using %s" % (
+                                name, ex, last_good))
+                    self.cache[name] = (last_good, now + self.negative_ttl,
+                                        last_good)
+                    return last_good
+                log.warning("Can't resolve %s: %s" % (name, ex))
+                self.cache[name] = (None, now + self.negative_ttl, None)
+            raise
+        with self.lock:
+            self.cache[name] = (address, now + self.ttl, address)
+        return address
+
+    def stats(self):
+        return "%s names, %s hits, %s misses, %s failures" % (
+            len(self.cache), self.hits, self.misses, self.failures)
+
+
+resolver = Resolver()
+
+
+# ###########################################################
+# #### connections (shared by the backends)
+
+class StreamConnection(object):
+    """
+    A long lived TCP connection to one destination, reused across runs (or
+    a unix domain socket one, when port is None and host is the path).
+    The connection is checked before every send (the servers we talk to
+    never send anything, so a readable socket means it was closed on us)
+    and reopened when needed. After a failure we wait before connecting
+    again, starting at a second and doubling up to reconnect_max, with
+    jitter so a restarted server isn't hit by everyone at once.
+    """
+    def __init__(self, host, port, connect_timeout=5.0, send_timeout=10.0,
+                 keepalive=True, reconnect_max=60.0, name=None):
+        self.host = host
+        self.port = port
+        self.connect_timeout = connect_timeout
+        self.send_timeout = send_timeout
+        self.keepalive = keepalive
+        self.reconnect_max = reconnect_max
+        self.name = name or "%s:%s" % (host, port)
+        self.log = logging.getLogger("log.backends.connection")
+        self.sock = None
+        self.backoff = 0
+        self.next_connect = 0
+        self.bytes_sent = 0
+        self.metrics_sent = 0
+        self.connects = 0
+        self.failures = 0
+
+    def healthy(self):
+        """
+        True if we have a connection that wasn't closed by the other side
+        """
+        if self.sock is None:
+            return False
+        try:
+            readable = select.select([self.sock], [], [], 0)[0]
+            if readable and not self.sock.recv(1, socket.MSG_PEEK):
+                self.log.info("%s closed the connection" % self.name)
+                self.close()
+                return False
+        except (socket.error, select.error, ValueError), ex:
+            self.log.info("%s connection is broken: %s" % (self.name, ex))
+            self.close()
+            return False
+        return True
+
+    def connect(self):
+        """
+        Makes sure we are connected, returns False if we can't be (or we are
+        still backing off from the last failure)
+        """
+        if self.healthy():
+            return True
+        if time.time() < self.next_connect:
+            self.log.debug("not reconnecting to %s for another %.1fs" % (
+                           self.name, self.next_connect - time.time()))
+            return False
+        self.log.debug("Connecting to %s" % self.name)
+        try:
+            if self.port is None:
+                sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                sock.settimeout(self.connect_timeout)
+                try:
+                    sock.connect(self.host)
+                except:
+                    sock.close()
+                    raise
+            else:
+                sock = socket.create_connection(
+                    (resolver.resolve(self.host), self.port),
+                    self.connect_timeout)
+        except (socket.error, socket.timeout), ex:
+            self.log.warning("Can't connect to %s: %s" % (self.name, ex))
+            self.failed()
+            return False
+        sock.settimeout(self.send_timeout)
+        if self.keepalive and self.port is not None:
+            self.set_keepalive(sock)
+        self.sock = sock
+        self.backoff = 0
+        self.connects += 1
+        self.log.debug("connected to %s" % self.name)
+        return True
+
+    def set_keepalive(self, sock):
+        """
+        turns on tcp keepalive, so dead peers are noticed between runs
+        """
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        # linux only, the defaults take hours to notice anything
+        for (opt, value) in (('TCP_KEEPIDLE', 60), ('TCP_KEEPINTVL', 10),
+                             ('TCP_KEEPCNT', 3)):
+            if hasattr(socket, opt):
+                sock.setsockopt(socket.IPPROTO_TCP, getattr(socket, opt),
+                                value)
+
+    def failed(self):
+        """
+        closes the connection and schedules the next connect attempt
+        """
+        self.close()
+        self.failures += 1
+        self.backoff = min(max(self.backoff * 2, 1), self.reconnect_max)
+        self.next_connect = time.time() + random.uniform(0.5, 1.0) * \
+            self.backoff
+
+    def sendall(self, messages, num_metrics=0):
+        """
+        Sends every message in messages, returns False (and drops the
+        connection) on failure
+        """
+        if not self.connect():
+            return False
+        try:
+            for message in messages:
+                self.sock.sendall(message)
+                self.bytes_sent += len(message)
+        except (socket.error, socket.timeout), ex:
+            self.log.critical("Can't send message to %s error:%s" % (
+                              self.name, ex))
+            self.failed()
+            return False
+        self.metrics_sent += num_metrics
+        return True
+
+    def close(self):
+        if self.sock is not None:
+            try:
+                self.sock.close()
+            except socket.error:
+                pass
+            self.sock = None
+
+    def stats(self):
+        return ("%s: %s connects, %s failures, %s bytes, %s metrics sent" %
+                (self.name, self.connects, self.failures, self.bytes_sent,
+                 self.metrics_sent))
+
+
+class ConsistentHashRing(object):
+    """
+    The hash ring carbon-relay's ConsistentHashingRouter uses (carbon's
+    hashing.py), so a metric goes to the same carbon-cache whether it came
+    through a relay or from us. Nodes are (server, instance) tuples, and
+    have to be named exactly like the DESTINATIONS in carbon.conf.
+    """
+    def __init__(self, nodes, replica_count=100):
+        self.ring = []
+        self.nodes = []
+        self.replica_count = replica_count
+        for node in nodes:
+            self.add_node(node)
+
+    def compute_ring_position(self, key):
+        return int(hashlib.md5(str(key)).hexdigest()[:4], 16)
+
+    def add_node(self, node):
+        self.nodes.append(node)
+        positions = set(position for (position, n) in self.ring)
+        for i in xrange(self.replica_count):
+            replica_key = "%s:%d" % (node, i)
+            position = self.compute_ring_position(replica_key)
+            while position in positions:
+                position += 1
+            positions.add(position)
+            bisect.insort(self.ring, (position, node))
+
+    def get_nodes(self, key, count):
+        """
+        Returns the first count distinct nodes on the ring after key
+        """
+        nodes = []
+        index = bisect.bisect_left(self.ring,
+                                   (self.compute_ring_position(key), None))
+        for i in xrange(len(self.ring)):
+            node = self.ring[(index + i) % len(self.ring)][1]
+            if node not in nodes:
+                nodes.append(node)
+                if len(nodes) == count:
+                    break
+        return nodes
+
+
+class HTTPConnectionPool(object):
+    """
+    Keeps HTTP/1.1 connections open between requests (and runs), per
+    scheme, host and port, so the http backends don't pay a tcp (and tls)
+    handshake for every chunk. A connection is only used by one request at
+    a time, concurrent requests get their own. Idle connections the server
+    closed are noticed before they are used, and a request on a reused
+    connection the server had closed (before reading it) is tried once more
+    on a new one.
+    """
+    # what a reused connection the server already closed fails with
+    STALE_ERRNOS = (errno.ECONNRESET, errno.EPIPE, errno.ECONNABORTED)
+
+    def __init__(self, max_idle=4):
+        self.max_idle = max_idle
+        self.log = logging.getLogger("log.backends.http")
+        self.lock = threading.Lock()
+        self.idle = {}   # (scheme, host, port): [connection, ...]
+        self.counts = {}  # (scheme, host, port): [connects, requests]
+
+    def endpoint(self, url):
+        """
+        splits url into ((scheme, host, port), path and query)
+        """
+        parts = urlparse.urlsplit(url)
+        port = parts.port
+        if port is None:
+            port = parts.scheme == "https" and 443 or 80
+        path = parts.path or "/"
+        if parts.query:
+            path = "%s?%s" % (path, parts.query)
+        return ((parts.scheme, parts.hostname, port), path)
+
+    def new_connection(self, key, timeout):
+        (scheme, host, port) = key
+        if scheme == "https":
+            conn = httplib.HTTPSConnection(host, port, timeout=timeout)
+        else:
+            conn = httplib.HTTPConnection(host, port, timeout=timeout)
+        counts = self.counts.setdefault(key, [0, 0])
+
+        def create_connection(address, *args):
+            # look the name up in the shared cache, tls still checks host
+            counts[0] += 1
+            return socket.create_connection(
+                (resolver.resolve(address[0]), address[1]), *args)
+        conn._create_connection = create_connection
+        return conn
+
+    def get(self, key, timeout):
+        """
+        returns (connection, True if it was used before)
+        """
+        with self.lock:
+            idle = self.idle.get(key, [])
+            while idle:
+                conn = idle.pop()
+                if self.usable(conn):
+                    conn.timeout = timeout
+                    conn.sock.settimeout(timeout)
+                    return (conn, True)
+                conn.close()
+            return (self.new_connection(key, timeout), False)
+
+    def usable(self, conn):
+        """
+        False if the server closed (or wrote something to) the idle conn
+        """
+        if conn.sock is None:
+            return False
+        try:
+            return not select.select([conn.sock], [], [], 0)[0]
+        except (select.error, socket.error, ValueError):
+            return False
+
+    def put(self, key, conn):
+        with self.lock:
+            idle = self.idle.setdefault(key, [])
+            if conn.sock is not None and len(idle) < self.max_idle:
+                idle.append(conn)
+            else:
+                conn.close()
+
+    def request(self, url, body, headers, timeout=5):
+        """
+        POSTs body to url, returns (status, reason, response body). Raises
+        socket.error or httplib.HTTPException when the request fails.
+        """
+        (key, path) = self.endpoint(url)
+        while True:
+            (conn, reused) = self.get(key, timeout)
+            try:
+                conn.request("POST", path, body, headers)
+                response = conn.getresponse()
+                data = response.read()
+            except (socket.error, httplib.HTTPException), ex:
+                conn.close()
+                if reused and self.stale(ex):
+                    self.log.debug("%s://%s:%s went stale (%s), reconnecting"
+                                   % (key + (ex,)))
+                    continue
+                raise
+            with self.lock:
+                self.counts[key][1] += 1
+            self.put(key, conn)
+            return (response.status, response.reason, data)
+
+    def stale(self, ex):
+        """
+        True if ex shows the server closed the connection without answering
+        (so it never got the request). A timeout never is, the request may
+        well be in the works, and sending it again could write it twice.
+        """
+        if isinstance(ex, socket.timeout):
+            return False
+        if isinstance(ex, httplib.BadStatusLine):
+            # no status line at all, the connection closed without an
+            # answer (how that reads depends on the python version)
+            return (ex.line in ("", "''") or
+                    ex.line.startswith("No status line received"))
+        if isinstance(ex, socket.error):
+            return ex.errno in self.STALE_ERRNOS
+        return False
+
+    def close(self):
+        """
+        closes the idle connections
+        """
+        with self.lock:
+            for idle in self.idle.values():
+                for conn in idle:
+                    conn.close()
+            self.idle.clear()
+
+    def stats(self):
+        return ", ".join(["%s://%s:%s %s connects %s requests" % (
+                          key + tuple(counts))
+                          for (key, counts) in self.counts.items()])
+
+
+# one pool for all the http backends
+http_pool = HTTPConnectionPool()
+
+
+def get_compression(cfg, log):
+    """
+    returns the gzip level to compress http requests with, or None
+    """
+    if not cfg.get('http_compression', False):
+        return None
+    try:
+        level = int(cfg.get('http_compression_level', 6))
+    except ValueError:
+        level = -1
+    if not 0 <= level <= 9:
+        log.critical("http_compression_level needs to be 0 to 9")
+        sys.exit(1)
+    return level
+
+
+def gzip_request(body, headers, level, log):
+    """
+    Returns body gzipped at level, and headers with Content-Encoding set
+    """
+    start = time.time()
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    compressed = compressor.compress(body) + compressor.flush()
+    log.debug("gzipped request from %s to %s bytes in %.2fms" % (
+              len(body), len(compressed), (time.time() - start) * 1000))
+    headers = dict(headers)
+    headers['Content-Encoding'] = 'gzip'
+    return (compressed, headers)
+
+
+def get_float_option(cfg, name, default, log):
+    """
+    returns cfg[name] as a float, exits when it isn't one
+    """
+    try:
+        return float(cfg.get(name, default))
+    except (TypeError, ValueError):
+        log.critical("%s needs to be a number" % name)
+        sys.exit(1)
+
+
 # ###########################################################
 # #### Librato Backend
 
@@ -26,11 +618,15 @@ class librato(object):
         self.api = "https://metrics-api.librato.com"
         self.sink_name = "graphios-librato"
         self.sink_version = "0.0.1"
-        self.flush_timeout_secs = 5
+        self.flush_timeout_secs = get_float_option(cfg, 'librato_timeout', 5,
+                                                   self.log)
         self.gauges = {}
+        self.counts = {}  # how many metrics went into each gauge
         self.whitelist = []
         self.metrics_sent = 0
         self.max_metrics_payload = 500
+        self.pool = None
+        self.pending = collections.deque()
 
         try:
             cfg["librato_email"]
@@ -79,16 +675,47 @@ class librato(object):
                 self.log.debug("adding librato whitelist pattern %s" % pattern)
                 self.whitelist.append(re.compile(pattern))
 
-    def build_path(self, vals, m):
-        path = ''
-        for s in vals:
-            path += getattr(m, s)
-            path += '.'
-        path = re.sub(r"^\.", '', path)  # fix sources that begin in dot
-        path = re.sub(r"\.$", '', path)  # fix sources that end in dot
-        path = re.sub(r"\.\.", '.', path)  # fix sources with double dots
-        path = re.sub(r"['\"]", '.', path)  # fix sources with imbedded quotes
-        return path
+        self.compression = get_compression(cfg, self.log)
+
+        try:
+            self.flush_workers = int(cfg.get('librato_flush_workers', 4))
+            self.max_buffer = int(cfg.get('librato_max_buffer', 50000))
+        except ValueError:
+            self.log.critical("librato_flush_workers and librato_max_buffer "
+                              "need to be integers")
+            sys.exit(1)
+        self.flush_workers = max(self.flush_workers, 1)
+
+        # imbedded quotes become dots
+        self.name_namer = MetricNamer(cfg, self.namevals, "'\"", ".")
+        self.source_namer = MetricNamer(cfg, self.sourcevals, "'\"", ".")
+
+        # whitelist decisions per series, keyed on the fields the name and
+        # source are built from, so rejected series never get a path built
+        patterns = [p.pattern for p in self.whitelist]
+        self.whitelist_all = ".*" in patterns or "" in patterns
+        self.whitelist_re = self.compile_whitelist(patterns)
+        self.decisions = LRUCache(self.name_namer.cache.size)
+
+    def compile_whitelist(self, patterns):
+        """
+        Returns one regex that matches what any of the whitelist patterns
+        match, or None if they can't be combined
+        """
+        # inline flags like (?i) would apply to every combined pattern, and
+        # group numbers shift when combined, so \1 would refer to another
+        # pattern's group (a backreference needs a group, so checking for
+        # groups covers those)
+        if [p for p in patterns if "(?" in p or re.compile(p).groups]:
+            self.log.debug("not combining the librato whitelist patterns, "
+                           "some of them use (?...) or groups")
+            return None
+        try:
+            return re.compile("|".join(["(?:%s)" % p for p in patterns]))
+        except re.error:
+            # shouldn't happen, they all compiled on their own
+            self.log.debug("can't combine the librato whitelist patterns")
+            return None
 
     def k_not_in_whitelist(self, k):
         # return True if k isn't whitelisted
@@ -98,70 +725,88 @@ class librato(object):
                 return False
         return True
 
+    def whitelisted(self, m):
+        """
+        True if the series of m is whitelisted
+        """
+        if self.whitelist_all:
+            return True
+        key = (self.name_namer.getter(m), self.source_namer.getter(m))
+        decision = self.decisions.get(key)
+        if decision is None:
+            k = "%s\t%s" % (self.name_namer.path(m), self.source_namer.path(m))
+            if self.whitelist_re is not None:
+                decision = self.whitelist_re.search(k) is not None
+            else:
+                decision = not self.k_not_in_whitelist(k)
+            self.decisions.put(key, decision)
+        return decision
+
     def add_measure(self, m):
         ts = int(m.TIMET)
         if self.floor_time_secs is not None:
             ts = (ts / self.floor_time_secs) * self.floor_time_secs
 
-        source = self.build_path(self.sourcevals, m)
-        name = self.build_path(self.namevals, m)
+        source = self.source_namer.path(m)
+        name = self.name_namer.path(m)
 
-        k = "%s\t%s" % (name, source)
-
-        # bail if this metric isn't whitelisted
-        if self.k_not_in_whitelist(k):
-            return None
+        # batches can hold several spool files, so the same series can show
+        # up for more than one (floored) time, those are separate gauges
+        k = (name, source, ts)
 
         # add the metric to our gauges dict
         if k not in self.gauges:
+            if len(self.gauges) >= self.max_buffer:
+                # full, send what we have instead of growing
+                self.flush()
             self.gauges[k] = {
                 'name': name,
                 'source': source,
                 'measure_time': ts,
             }
+            self.counts[k] = 0
+        self.counts[k] += 1
 
-        value = float(m.VALUE)
-        self.gauges[k]['value'] = value
+        self.gauges[k]['value'] = m.VALUE
 
     def flush_payload(self, headers, g):
         """
-        POST a payload to Librato.
+        POST a payload to Librato, returns True if it was accepted
         """
         body = json.dumps({'gauges': g})
         url = "%s/v1/metrics" % (self.api)
-        req = urllib2.Request(url, body, headers)
+        if self.compression is not None:
+            (body, headers) = gzip_request(body, headers, self.compression,
+                                           self.log)
 
         try:
-            f = urllib2.urlopen(req, timeout=self.flush_timeout_secs)
-            # f.read()
-            f.close()
-        except urllib2.HTTPError as error:
-            self.metrics_sent = 0
-            body = error.read()
+            (status, reason, body) = http_pool.request(
+                url, body, headers, self.flush_timeout_secs)
+        except (socket.error, httplib.HTTPException) as error:
+            self.log.warning('Error when sending metrics Librato \
+                                (%s)' % (error))
+            return False
+        if status >= 300:
             self.log.warning('Failed to send metrics to Librato: Code: \
-                                %d . Response: %s' % (error.code, body))
-        except IOError as error:
-            self.metrics_sent = 0
-            if hasattr(error, 'reason'):
-                self.log.warning('Error when sending metrics Librato \
-                                    (%s)' % (error.reason))
-            elif hasattr(error, 'code'):
-                self.log.warning('Error when sending metrics Librato \
-                                    (%s)' % (error.code))
-            else:
-                self.log.warning('Error when sending metrics Librato \
-                                    and I dunno why')
+                                %d . Response: %s' % (status, body))
+            return False
+        return True
 
     def flush(self):
         """
-        POST a collection of gauges to Librato.
+        POST the buffered gauges to Librato, in payloads of at most
+        max_metrics_payload gauges, up to librato_flush_workers at a time.
+        The buffer is always emptied.
         """
+        (gauges, counts) = (self.gauges, self.counts)
+        self.gauges = {}
+        self.counts = {}
         # Nothing to do
-        if len(self.gauges) == 0:
+        if len(gauges) == 0:
             return 0
 
-        # Limit our payload sizes
-        # max_metrics_payload = 500  # this is never used, delete it?
+        if self.pool is None:
+            self.pool = multiprocessing.pool.ThreadPool(self.flush_workers)
 
         headers = {
             'Content-Type': 'application/json',
@@ -169,20 +814,37 @@ class librato(object):
             'Authorization': 'Basic %s' % self.build_basic_auth()
         }
 
-        metrics = []
-        count = 0
-        for g in self.gauges.values():
-            metrics.append(g)
-            count += 1
-
-            if count >= self.max_metrics_payload:
-                self.flush_payload(headers, metrics)
-                count = 0
-                metrics = []
-
-        if count > 0:
-            self.flush_payload(headers, metrics)
-            self.gauges = {}
+        # one measure_time per payload, so a payload never has the same
+        # series twice
+        times = {}
+        for k in gauges:
+            times.setdefault(k[2], []).append(k)
+        for ts in sorted(times):
+            keys = times[ts]
+            for i in xrange(0, len(keys), self.max_metrics_payload):
+                payload_keys = keys[i:i + self.max_metrics_payload]
+                payload = [gauges[k] for k in payload_keys]
+                num_metrics = sum([counts[k] for k in payload_keys])
+                self.pending.append((self.pool.apply_async(
+                    self.flush_payload, (headers, payload)), num_metrics))
+                # keep the number of payloads waiting for a worker bounded
+                while len(self.pending) > self.flush_workers:
+                    self.collect()
+
+    def collect(self):
+        """
+        waits for the oldest payload in flight, and counts its metrics if
+        it made it. That only makes the count in the logs right, graphios
+        can't tell which metrics of a batch were in a failed payload
+        """
+        (result, num_metrics) = self.pending.popleft()
+        try:
+            ok = result.get()
+        except Exception as ex:
+            self.log.warning('Error when sending metrics Librato (%s)' % ex)
+            ok = False
+        if ok:
+            self.metrics_sent += num_metrics
 
     def build_basic_auth(self):
 
@@ -201,21 +863,34 @@ class librato(object):
             system = os.name()
 
         pver = sys.version_info
-        user_agent = '%s/%s (%s) Python-Urllib2/%d.%d' % \
+        user_agent = '%s/%s (%s) Python-httplib/%d.%d' % \
                      (sink_name, sink_version,
                       system, pver[0], pver[1])
         return user_agent
 
     def send(self, metrics):
 
-        self.metrics_sent = len(metrics)
+        start = time.time()
+        accepted = [m for m in metrics if self.whitelisted(m)]
+        self.log.debug("whitelist: %s of %s metrics in %.2fms, decision "
+                       "cache: %s" % (len(accepted), len(metrics),
+                                      (time.time() - start) * 1000,
+                                      self.decisions.stats()))
+        # metrics that aren't whitelisted are done with
+        self.metrics_sent = len(metrics) - len(accepted)
         # Construct the output
-        for m in metrics:
+        for m in accepted:
             self.add_measure(m)
 
         # Flush
         self.flush()
+        while self.pending:
+            self.collect()
 
+        self.log.debug("name cache: %s, source cache: %s" %
+                       (self.name_namer.cache.stats(),
+                        self.source_namer.cache.stats()))
+        self.log.debug("http connections: %s" % http_pool.stats())
         return self.metrics_sent
 
 
@@ -282,34 +957,124 @@ class carbon(object):
         except:
             self.carbon_plaintext = False
 
+        # we want: (prefix.)hostname(.service_desc)(.postfix).perfdata
+        if self.use_service_desc:
+            fields = ['METRICBASEPATH', 'GRAPHITEPREFIX', 'HOSTNAME',
+                      'SERVICEDESC', 'GRAPHITEPOSTFIX', 'LABEL']
+        else:
+            fields = ['METRICBASEPATH', 'GRAPHITEPREFIX', 'HOSTNAME',
+                      'GRAPHITEPOSTFIX', 'LABEL']
+        self.namer = MetricNamer(cfg, fields, CARBON_INVALID_CHARS,
+                                 self.replacement_character)
+
+        connect_timeout = get_float_option(cfg, 'carbon_connect_timeout', 5,
+                                           self.log)
+        send_timeout = get_float_option(cfg, 'carbon_send_timeout', 10,
+                                        self.log)
+        reconnect_max = get_float_option(cfg, 'carbon_reconnect_max', 60,
+                                         self.log)
+        keepalive = cfg.get('carbon_keepalive', True)
+        self.buffer = cStringIO.StringIO()
+        self.connections = []
+        self.carbon_routing = cfg.get('carbon_routing', 'all')
+        nodes = {}
+        for serv in self.carbon_servers.split(","):
+            (server, port, instance) = self.parse_server(serv.strip())
+            # carbon-relay places (server, instance) on the ring, the port
+            # doesn't matter there
+            if self.carbon_routing == 'consistent-hashing':
+                node = (server, instance)
+            else:
+                node = (server, port)
+            if node in nodes:
+                self.log.critical("carbon server %s is listed twice" % serv)
+                sys.exit(1)
+            nodes[node] = len(self.connections)
+            self.connections.append(StreamConnection(
+                server, port, connect_timeout, send_timeout, keepalive,
+                reconnect_max, name="carbon %s:%s" % (server, port)))
+
+        if self.carbon_routing == 'consistent-hashing':
+            try:
+                self.replication_factor = int(
+                    cfg.get('carbon_replication_factor', 1))
+            except ValueError:
+                self.log.critical("carbon_replication_factor needs to be a "
+                                  "integer")
+                sys.exit(1)
+            # carbon-relay adds the nodes in DESTINATIONS order, which
+            # matters when two positions on the ring collide
+            ring = ConsistentHashRing(sorted(nodes, key=nodes.get))
+            self.shards = LRUCache(self.namer.cache.size)
+            self.get_shards = lambda path: [
+                nodes[n] for n in ring.get_nodes(path,
+                                                 self.replication_factor)]
+        elif self.carbon_routing != 'all':
+            self.log.critical("carbon_routing needs to be all or "
+                              "consistent-hashing")
+            sys.exit(1)
+
+    def parse_server(self, serv):
+        """
+        splits a carbon_servers entry, server[:port[:instance]], into
+        (server, port, instance)
+        """
+        parts = serv.split(":")
+        server = parts[0]
+        instance = None
+        if self.carbon_plaintext:
+            port = 2003
+        else:
+            port = 2004
+        try:
+            if len(parts) > 1 and parts[1]:
+                port = int(parts[1])
+            if len(parts) > 2 and parts[2]:
+                instance = parts[2]
+        except ValueError:
+            self.log.critical("bad port in carbon_servers: %s" % serv)
+            sys.exit(1)
+        if len(parts) > 3:
+            self.log.critical("bad carbon_servers entry: %s" % serv)
+            sys.exit(1)
+        return (server, port, instance)
+
     def convert_messages(self, metrics):
         """
-        Converts the metric obj list into graphite messages
+        Converts the metric obj list into graphite messages, each one holding
+        at most carbon_max_metrics metrics
         """
-        metric_list = []
+        path = self.build_path
+        if self.carbon_plaintext:
+            metric_list = ["%s %s %s\n" % (path(m), m.VALUETEXT, m.TIMET)
+                           for m in metrics]
+        else:
+            metric_list = [(path(m), (m.TIMET, m.VALUE)) for m in metrics]
         messages = []
-        for m in metrics:
-            path = self.build_path(m)
-            value = m.VALUE
-            timestamp = m.TIMET
-            if self.carbon_plaintext:
-                metric_item = "%s %s %s\n" % (path, value, timestamp)
-            else:
-                metric_item = (path, (timestamp, value))
-            if self.test_mode:
-                print "%s %s %s" % (path, value, timestamp)
-            metric_list.append(metric_item)
         for metric_list_chunk in self.chunks(metric_list,
                                              self.carbon_max_metrics):
             if self.carbon_plaintext:
                 messages.append("".join(metric_list_chunk))
             else:
-                payload = pickle.dumps(metric_list_chunk)
-                header = struct.pack("!L", len(payload))
-                message = header + payload
-                messages.append(message)
+                messages.append(self.pickle_message(metric_list_chunk))
         return messages
 
+    def pickle_message(self, metric_list):
+        """
+        Returns the length header and the pickled metric_list as one string.
+        The pickle is written straight after room left for the header, so
+        the payload isn't copied again to put the header in front of it.
+        """
+        buf = self.buffer
+        buf.reset()
+        buf.truncate()
+        buf.write("\0\0\0\0")
+        pickle.dump(metric_list, buf, CARBON_PICKLE_PROTOCOL)
+        size = buf.tell() - 4
+        buf.reset()
+        buf.write(struct.pack("!L", size))
+        return buf.getvalue()
+
     def chunks(self, l, n):
         """ Yield successive n-sized chunks from l.
         """
@@ -320,79 +1085,76 @@ class carbon(object):
         """
         Builds a carbon metric
         """
-        pre = ""
-        if m.METRICBASEPATH != "":
-            pre = "%s." % m.METRICBASEPATH
-        if m.GRAPHITEPREFIX != "":
-            pre += "%s." % m.GRAPHITEPREFIX
-        if m.GRAPHITEPOSTFIX != "":
-            post = ".%s" % m.GRAPHITEPOSTFIX
-        else:
-            post = ""
-        # if self.replace_hostname:
-        #     hostname = m.HOSTNAME.replace('.', self.replacement_character)
-        # else:
-        hostname = m.HOSTNAME
-        if self.use_service_desc:
-            # we want: (prefix.)hostname.service_desc(.postfix).perfdata
-            service_desc = self.fix_string(m.SERVICEDESC)
-            path = "%s%s.%s%s.%s" % (pre, hostname, service_desc, post,
-                                     m.LABEL)
-        else:
-            path = "%s%s%s.%s" % (pre, hostname, post, m.LABEL)
-        path = re.sub(r"\.$", '', path)  # fix paths that end in dot
-        path = re.sub(r"\.\.", '.', path)  # fix paths with double dots
-        path = self.fix_string(path)
-        return path
+        return self.namer.path(m)
 
     def fix_string(self, my_string):
         """
         takes a string and replaces whitespace and invalid carbon chars with
         the global replacement_character
         """
-        invalid_chars = '~!$:;%^*()+={}[]|\/<>'
-        my_string = re.sub("\s", self.replacement_character, my_string)
-        for char in invalid_chars:
-            my_string = my_string.replace(char, self.replacement_character)
-        return my_string
+        return self.namer.sanitize(my_string)
+
+    def shard(self, metrics):
+        """
+        Splits metrics up by the carbon servers (indexes into
+        self.connections) that own them
+        """
+        shards = {}
+        for m in metrics:
+            path = self.build_path(m)
+            owners = self.shards.get(path)
+            if owners is None:
+                owners = self.get_shards(path)
+                self.shards.put(path, owners)
+            for owner in owners:
+                shards.setdefault(owner, []).append(m)
+        return shards
+
+    def send_sharded(self, metrics):
+        """
+        Sends every metric to the carbon server(s) that own it, returns the
+        number of metrics that made it to all of their servers
+        """
+        lost = set()
+        for (owner, shard_metrics) in self.shard(metrics).iteritems():
+            messages = self.convert_messages(shard_metrics)
+            if not self.connections[owner].sendall(messages,
+                                                   len(shard_metrics)):
+                lost.update(id(m) for m in shard_metrics)
+        self.log.debug("shard cache: %s" % self.shards.stats())
+        return len(metrics) - len(lost)
 
     def send(self, metrics):
         """
-        Connect to the Carbon server
-        Send the metrics
+        Send the metrics to every carbon server (or only the ones that own
+        them with consistent hashing), over connections that are kept open
+        between runs
         """
-        ret = 0
-        sock = socket.socket()
-        servers = self.carbon_servers.split(",")
-        for serv in servers:
-            if ":" in serv:
-                server, port = serv.split(":")
-                port = int(port)
-            else:
-                server = serv
-                if self.carbon_plaintext:
-                    port = 2003
-                else:
-                    port = 2004
-            self.log.debug("Connecting to carbon at %s:%s" % (server, port))
-            try:
-                sock.connect((socket.gethostbyname(server), port))
-                self.log.debug("connected")
-            except Exception, ex:
-                self.log.warning("Can't connect to carbon: %s:%s %s" % (
-                                 server, port, ex))
+        if self.test_mode:
+            for m in metrics:
+                print "%s %s %s" % (self.build_path(m), m.VALUETEXT, m.TIMET)
+        if self.carbon_routing == 'consistent-hashing':
+            ret = self.send_sharded(metrics)
+        else:
+            ret = self.send_all(metrics)
+        for conn in self.connections:
+            self.log.debug(conn.stats())
+        self.log.debug("path cache: %s" % self.namer.cache.stats())
+        self.log.debug("dns cache: %s" % resolver.stats())
+        return ret
 
-            messages = self.convert_messages(metrics)
-            try:
-                for message in messages:
-                    sock.sendall(message)
-            except Exception, ex:
-                self.log.critical("Can't send message to carbon error:%s" % ex)
-                sock.close()
+    def send_all(self, metrics):
+        """
+        Sends every metric to every carbon server
+        """
+        ret = 0
+        # every server gets the same messages, only build them once
+        messages = self.convert_messages(metrics)
+        for conn in self.connections:
+            if not conn.sendall(messages, len(metrics)):
                 return 0
             # this only gets returned if nothing failed.
             ret += len(metrics)
-            sock.close()
         return ret
 
 
@@ -400,6 +1162,8 @@ class carbon(object):
 # #### statsd backend  #######################################
 
 class statsd(object):
+    STREAM_CHUNK = 65536  # bytes per write on tcp and unix sockets
+
     def __init__(self, cfg):
         self.log = logging.getLogger("log.backends.statsd")
         self.log.info("Statsd backend initialized")
@@ -410,61 +1174,162 @@ class statsd(object):
         else:
             self.statsd_servers = cfg['statsd_servers']
 
+        try:
+            self.statsd_mtu = int(cfg.get('statsd_mtu', 512))
+        except ValueError:
+            self.log.critical("statsd_mtu needs to be a integer")
+            sys.exit(1)
+        connect_timeout = get_float_option(cfg, 'statsd_connect_timeout', 5,
+                                           self.log)
+        send_timeout = get_float_option(cfg, 'statsd_send_timeout', 10,
+                                        self.log)
+
+        self.namer = MetricNamer(cfg, ['METRICBASEPATH', 'GRAPHITEPREFIX',
+                                       'HOSTNAME', 'GRAPHITEPOSTFIX', 'LABEL'])
+        self.types = {}
+        self.servers = []
+        self.streams = []
+        for serv in self.statsd_servers.split(","):
+            serv = serv.strip()
+            (scheme, sep, rest) = serv.partition("://")
+            if not sep:
+                (scheme, rest) = ("udp", serv)
+            if scheme == "unix":
+                self.streams.append(StreamConnection(
+                    rest, None, connect_timeout, send_timeout,
+                    name="statsd %s" % serv))
+                continue
+            elif scheme not in ("udp", "tcp"):
+                self.log.critical("statsd_servers can only be udp://, tcp:// "
+                                  "or unix://, not %s" % serv)
+                sys.exit(1)
+            if ":" in rest:
+                server, port = rest.split(":")
+                try:
+                    port = int(port)
+                except ValueError:
+                    self.log.critical("bad port in statsd_servers: %s" % serv)
+                    sys.exit(1)
+            else:
+                server = rest
+                port = 8125
+            if scheme == "tcp":
+                self.streams.append(StreamConnection(
+                    server, port, connect_timeout, send_timeout,
+                    name="statsd %s" % serv))
+            else:
+                self.servers.append((server, port))
+        self.sock = None
+
     def set_type(self, metric):
-        # detect and set the metric type
+        # detect and set the metric type, once per METRICTYPE
+        try:
+            return self.types[metric.METRICTYPE]
+        except KeyError:
+            pass
         if re.search("gauge", metric.METRICTYPE):
-            return 'g'
+            mtype = 'g'
         elif re.search("counter", metric.METRICTYPE):
-            return 'c'
+            mtype = 'c'
         elif re.search("time", metric.METRICTYPE):
-            return 'ms'
+            mtype = 'ms'
         elif re.search("set", metric.METRICTYPE):
-            return 's'
+            mtype = 's'
         else:
-            return 'g'  # default to gauge
+            mtype = 'g'  # default to gauge
+        self.types[metric.METRICTYPE] = mtype
+        return mtype
 
     def convert(self, metrics):
         # Converts the metric object list into a list of statsd tuples
         out_list = []
         for m in metrics:
-            path = '%s.%s.%s.%s.%s' % (m.METRICBASEPATH, m.GRAPHITEPREFIX,
-                                       m.HOSTNAME, m.GRAPHITEPOSTFIX,
-                                       m.LABEL)
-            path = re.sub(r'\.$', '', path)  # fix paths that end in dot
-            path = re.sub(r'\.\.', '.', path)  # fix paths with empty values
+            path = self.namer.path(m)
             mtype = self.set_type(m)  # gauge|counter|timer|set
-            value = "%s|%s" % (m.VALUE, mtype)  # emit literally this to statsd
+            value = "%s|%s" % (m.VALUETEXT, mtype)  # emit this to statsd
             metric_tuple = "%s:%s" % (path, value)
             out_list.append(metric_tuple)
 
         return out_list
 
+    def pack(self, mlist, max_size):
+        """
+        Packs the statsd lines into newline separated datagrams of at most
+        max_size bytes, returns a list of (datagram, number of metrics)
+        """
+        packets = []
+        lines = []
+        size = 0
+        for m in mlist:
+            if lines and size + 1 + len(m) > max_size:
+                packets.append(("\n".join(lines), len(lines)))
+                lines = []
+                size = 0
+            if lines:
+                size += 1
+            lines.append(m)
+            size += len(m)
+        if lines:
+            packets.append(("\n".join(lines), len(lines)))
+        return packets
+
+    def send_stream(self, conn, mlist):
+        """
+        Writes the metrics as newline terminated lines to a tcp or unix
+        socket, returns how many were written before anything failed
+        """
+        ret = 0
+        for (chunk, num_metrics) in self.pack(mlist, self.STREAM_CHUNK):
+            if not conn.sendall([chunk + "\n"], num_metrics):
+                break
+            ret += num_metrics
+        self.log.debug(conn.stats())
+        return ret
+
     def send(self, metrics):
+        """
+        Sends every metric to every statsd server, returns how many metrics
+        the worst off server got (like carbon, a metric only counts once
+        every server has it)
+        """
+        mlist = self.convert(metrics)
+        sent = [self.send_stream(conn, mlist) for conn in self.streams]
+        if self.servers:
+            sent.extend(self.send_udp(mlist))
+        self.log.debug("path cache: %s" % self.namer.cache.stats())
+        self.log.debug("dns cache: %s" % resolver.stats())
+        if not sent:
+            return 0
+        return min(sent)
+
+    def send_udp(self, mlist):
+        """
+        Sends the metrics to each udp server, returns a list of how many
+        metrics went out to each of them
+        """
         # Fire metrics at the statsd server and hope for the best (loludp)
-        ret = True
-        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        if self.sock is None:
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
 
-        mlist = self.convert(metrics)
-        ret = 0
-        servers = self.statsd_servers.split(",")
-        for serv in servers:
-            if ":" in serv:
-                server, port = serv.split(":")
-                port = int(port)
-            else:
-                server = serv
-                port = 8125
-            self.log.debug("sending to statsd at %s:%s" % (server, port))
-            for m in mlist:
+        sent = []
+        packets = self.pack(mlist, self.statsd_mtu)
+        for (server, port) in self.servers:
+            sent.append(0)
+            try:
+                address = resolver.resolve(server)
+            except socket.error:
+                continue
+            self.log.debug("sending %s packets to statsd at %s:%s" % (
+                           len(packets), server, port))
+            for (packet, num_metrics) in packets:
                 try:
-                    sock.sendto(m, (socket.gethostbyname(server), port))
-                except Exception, ex:
+                    self.sock.sendto(packet, (address, port))
+                except socket.error, ex:
                     self.log.critical("Can't send metric to statsd error:%s"
                                       % ex)
                 else:
-                    ret += 1
-
-        return ret
+                    sent[-1] += num_metrics
+        return sent
 
 
 # ###########################################################
@@ -476,7 +1341,7 @@ class influxdb(object):
         self.log.info("InfluxDB backend initialized")
         self.scheme = "http"
         self.default_ports = {'https': 8087, 'http': 8086}
-        self.timeout = 5
+        self.timeout = get_float_option(cfg, 'influxdb_timeout', 5, self.log)
 
         if 'influxdb_use_ssl' in cfg:
             if cfg['influxdb_use_ssl']:
@@ -516,6 +1381,12 @@ class influxdb(object):
             self.log.critical("influxdb_max_metrics needs to be a integer")
             sys.exit(1)
 
+        self.compression = get_compression(cfg, self.log)
+
+        self.namer = MetricNamer(cfg, ['METRICBASEPATH', 'GRAPHITEPREFIX',
+                                       'HOSTNAME', 'SERVICEDESC', 'LABEL',
+                                       'GRAPHITEPOSTFIX'])
+
     def build_url(self, server):
         """ Returns a url to specified InfluxDB-server """
         test_port = server.split(':')
@@ -529,57 +1400,36 @@ class influxdb(object):
 
     def build_path(self, m):
         """ Returns a path """
-        path = ""
-        if m.METRICBASEPATH != "":
-            path += "%s." % m.METRICBASEPATH
-
-        if m.GRAPHITEPREFIX != "":
-            path += "%s." % m.GRAPHITEPREFIX
-
-        path += "%s." % m.HOSTNAME
-
-        if m.SERVICEDESC != "":
-            path += "%s." % m.SERVICEDESC
-
-        path = "%s%s" % (path, m.LABEL)
-
-        if m.GRAPHITEPOSTFIX != "":
-            path = "%s.%s" % (path, m.GRAPHITEPOSTFIX)
-
-        return path
+        return self.namer.path(m)
 
     def chunks(self, l, n):
         """ Yield successive n-sized chunks from l. """
         for i in xrange(0, len(l), n):
             yield l[i:i+n]
 
-    def url_request(self, url, chunk):
+    def url_request(self, chunk):
+        """ Returns the body and headers to POST chunk with """
         json_body = json.dumps(chunk)
-        req = urllib2.Request(url, json_body)
-        req.add_header('Content-Type', 'application/json')
-        return req
+        return (json_body, {'Content-Type': 'application/json'})
 
     def _send(self, server, chunk):
-        self.log.debug("Connecting to InfluxDB at %s" % server)
-        req = self.url_request(self.build_url(server), chunk)
+        self.log.debug("Sending to InfluxDB at %s" % server)
+        (body, headers) = self.url_request(chunk)
+        if self.compression is not None:
+            (body, headers) = gzip_request(body, headers, self.compression,
+                                           self.log)
 
         try:
-            r = urllib2.urlopen(req, timeout=self.timeout)
-            r.close()
-            return True
-        except urllib2.HTTPError as e:
-            body = e.read()
-            self.log.warning('Failed to send metrics to InfluxDB. \
-                                Status code: %d: %s' % (e.code, body))
+            (status, reason, body) = http_pool.request(
+                self.build_url(server), body, headers, self.timeout)
+        except (socket.error, httplib.HTTPException) as e:
+            self.log.warning("Failed to send metrics to InfluxDB. %s" % e)
             return False
-        except IOError as e:
-            fail_string = "Failed to send metrics to InfluxDB. "
-            if hasattr(e, 'code'):
-                fail_string = fail_string + "Status code: %s" % e.code
-            if hasattr(e, 'reason'):
-                fail_string = fail_string + str(e.reason)
-            self.log.warning(fail_string)
+        if status >= 300:
+            self.log.warning('Failed to send metrics to InfluxDB. \
+                                Status code: %d: %s' % (status, body))
             return False
+        return True
 
     def send(self, metrics):
         """ Connect to influxdb and send metrics """
@@ -597,16 +1447,8 @@ class influxdb(object):
             # influx assumes timestamp in milliseconds
             timet_ms = int(m.TIMET)*1000
 
-            # Ensure a int/float gets passed
-            try:
-                value = int(m.VALUE)
-            except ValueError:
-                try:
-                    value = float(m.VALUE)
-                except ValueError:
-                    value = 0
-
-            perfdata[path].append([timet_ms, value])
+            # m.VALUE is already an int/float
+            perfdata[path].append([timet_ms, m.VALUE])
 
         for k, v in perfdata.iteritems():
             series.append({"name": k, "columns": ["time", "value"],
@@ -618,6 +1460,7 @@ class influxdb(object):
                 if not self._send(s, chunk):
                     ret = 0
 
+        self.log.debug("http connections: %s" % http_pool.stats())
         return ret
 
 
@@ -640,6 +1483,16 @@ class influxdb09(influxdb):
         except:
             self.influxdb_line_protocol = False
 
+        try:
+            self.influxdb_max_bytes = int(cfg.get('influxdb_max_bytes',
+                                                  65536))
+        except ValueError:
+            self.log.critical("influxdb_max_bytes needs to be a integer")
+            sys.exit(1)
+        self.series_keys = LRUCache(self.namer.cache.size)
+        self.group_fields = cfg.get('influxdb_group_fields', False)
+        self.threshold_fields = cfg.get('influxdb_threshold_fields', False)
+
     def build_url(self, server):
         """ Returns a url to specified InfluxDB-server """
         test_port = server.split(':')
@@ -647,69 +1500,146 @@ class influxdb09(influxdb):
             server = "%s:%i" % (server, self.default_ports[self.scheme])
 
         if self.influxdb_line_protocol:
-            return "%s://%s/write?u=%s&p=%s&db=%s" % (self.scheme, server,
-                                                      self.influxdb_user,
-                                                      self.influxdb_password,
-                                                      self.influxdb_db)
+            return "%s://%s/write?u=%s&p=%s&db=%s&precision=s" % (
+                self.scheme, server, self.influxdb_user,
+                self.influxdb_password, self.influxdb_db)
         else:
             return "%s://%s/write?u=%s&p=%s" % (self.scheme, server,
                                                 self.influxdb_user,
                                                 self.influxdb_password)
 
-    def url_request(self, url, chunk):
+    def url_request(self, chunk):
         if self.influxdb_line_protocol:
-            req = urllib2.Request(url, chunk)
-            req.add_header('Content-Type', 'application/x-www-form-urlencoded')
-            return req
+            return (chunk,
+                    {'Content-Type': 'application/x-www-form-urlencoded'})
         else:
-            return super(influxdb09, self).url_request(url, chunk)
-
-    def format_metric(self, timestamp, path, tags, value):
-        if not self.influxdb_line_protocol:
-            return {
-                    "timestamp": timestamp,
-                    "measurement": path,
-                    "tags": tags,
-                    "fields": {"value": value}}
-        return '%s,%s value=%s %d' % (
-                path,
-                ','.join(['%s=%s' % (k, v) for k, v in tags.iteritems() if v]),
-                value,
-                timestamp * 10 ** 9
-                )
+            return super(influxdb09, self).url_request(chunk)
 
     def format_series(self, chunk):
-        if self.influxdb_line_protocol:
-            return '\n'.join(chunk)
-        else:
-            return {"database": self.influxdb_db, "points": chunk}
+        return {"database": self.influxdb_db, "points": chunk}
 
-    def send(self, metrics):
-        """ Connect to influxdb and send metrics """
-        ret = 0
-        perfdata = []
-        for m in metrics:
-            ret += 1
-
-            if (m.SERVICEDESC == ''):
-                path = m.HOSTCHECKCOMMAND
-            else:
-                path = m.SERVICEDESC
-
-            # Ensure a int/float gets passed
+    def series_key(self, m, label):
+        """
+        Returns the escaped "measurement,tag=value,..." part of the line
+        protocol for m, tags sorted by key like influxdb wants them
+        """
+        key = (m.SERVICEDESC, m.HOSTCHECKCOMMAND, label, m.HOSTNAME)
+        series = self.series_keys.get(key)
+        if series is None:
+            (path, tags) = self.series(m, label)
+            parts = [MEASUREMENT_ESCAPE_RE.sub(r"\\\1", path)]
+            for k in sorted(tags):
+                if tags[k]:
+                    parts.append("%s=%s" % (
+                        TAG_ESCAPE_RE.sub(r"\\\1", str(k)),
+                        TAG_ESCAPE_RE.sub(r"\\\1", str(tags[k]))))
+            series = ",".join(parts)
+            self.series_keys.put(key, series)
+        return series
+
+    def series(self, m, label):
+        """
+        Returns the measurement and tags for m, without the check tag when
+        label is empty
+        """
+        if (m.SERVICEDESC == ''):
+            path = m.HOSTCHECKCOMMAND
+        else:
+            path = m.SERVICEDESC
+        tags = {"check": label, "host": m.HOSTNAME}
+        tags.update(self.influxdb_extra_tags)
+        if not label:
+            del tags["check"]
+        return (path, tags)
+
+    def threshold_fields_of(self, m, prefix):
+        """
+        Returns the plain number warn/crit/min/max thresholds of m as
+        fields. Ranges (10:20, @10:20 ..) and missing ones are skipped.
+        """
+        fields = []
+        for (name, text) in zip(("warn", "crit", "min", "max"),
+                                m.THRESHOLDS.split(";")[1:]):
             try:
-                value = int(m.VALUE)
+                number = float(text)
             except ValueError:
-                try:
-                    value = float(m.VALUE)
-                except ValueError:
-                    value = 0
+                continue
+            if number - number == 0:  # not inf or nan
+                fields.append((prefix + name, repr(number), number))
+        return fields
 
-            tags = {"check": m.LABEL, "host": m.HOSTNAME}
-            tags.update(self.influxdb_extra_tags)
+    def points(self, metrics):
+        """
+        Yields (metric, label for the check tag, [(field, text, number)..])
+        for every point to write. That's a point per metric, or with
+        influxdb_group_fields a point per check, with each label a field.
+        """
+        if not self.group_fields:
+            for m in metrics:
+                fields = [("value", m.VALUETEXT, m.VALUE)]
+                if self.threshold_fields and m.THRESHOLDS:
+                    fields.extend(self.threshold_fields_of(m, ""))
+                yield (m, m.LABEL, fields)
+            return
+        # the labels of one spool line follow each other and share a header
+        for (header, group) in itertools.groupby(
+                metrics, operator.attrgetter('header')):
+            fields = []
+            for m in group:
+                fields.append((m.LABEL, m.VALUETEXT, m.VALUE))
+                if self.threshold_fields and m.THRESHOLDS:
+                    fields.extend(self.threshold_fields_of(m, m.LABEL + "_"))
+            yield (m, "", fields)
+
+    def encode_lines(self, metrics):
+        """
+        Writes the metrics as line protocol, with second timestamps, and
+        yields the batches as they reach influxdb_max_bytes (or
+        influxdb_max_metrics lines)
+        """
+        buf = cStringIO.StringIO()
+        size = 0
+        count = 0
+        for (m, label, fields) in self.points(metrics):
+            line = "%s %s %d\n" % (
+                self.series_key(m, label),
+                ",".join(["%s=%s" % (TAG_ESCAPE_RE.sub(r"\\\1", k), text)
+                          for (k, text, number) in fields]),
+                int(m.TIMET))
+            if count and (size + len(line) > self.influxdb_max_bytes or
+                          count >= self.influxdb_max_metrics):
+                yield buf.getvalue()
+                buf.reset()
+                buf.truncate()
+                size = 0
+                count = 0
+            buf.write(line)
+            size += len(line)
+            count += 1
+        if count:
+            yield buf.getvalue()
 
-            perfdata.append(self.format_metric(int(m.TIMET), path,
-                            tags, value))
+    def send(self, metrics):
+        """ Connect to influxdb and send metrics """
+        ret = len(metrics)
+        if self.influxdb_line_protocol:
+            for body in self.encode_lines(metrics):
+                for s in self.influxdb_servers:
+                    if not self._send(s, body):
+                        ret = 0
+            self.log.debug("series cache: %s" % self.series_keys.stats())
+            self.log.debug("http connections: %s" % http_pool.stats())
+            return ret
+
+        perfdata = []
+        for (m, label, fields) in self.points(metrics):
+            (path, tags) = self.series(m, label)
+            # m.VALUE is already an int/float
+            perfdata.append({
+                "timestamp": int(m.TIMET),
+                "measurement": path,
+                "tags": tags,
+                "fields": dict([(k, number) for (k, text, number) in fields])})
 
         series_chunks = self.chunks(perfdata, self.influxdb_max_metrics)
         for chunk in series_chunks:
@@ -718,6 +1648,7 @@ class influxdb09(influxdb):
                 if not self._send(s, series):
                     ret = 0
 
+        self.log.debug("http connections: %s" % http_pool.stats())
         return ret
 
 
@@ -0,0 +1,161 @@
+#!/usr/bin/python -tt
+# vim: set ts=4 sw=4 tw=79 et :
+#
+# Benchmarks for the graphios backends, run from the source directory:
+#
+#   python graphios_bench.py [--metrics 10000] [--rounds 20]
+#
+# Nothing is sent anywhere but to a local stand-in http server, it measures
+# what graphios does with the cpu before the metrics hit the network.
+
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from optparse import OptionParser
+from SocketServer import ThreadingMixIn
+import threading
+import time
+import urllib2
+
+import graphios
+import graphios_backends as backends
+
+parser = OptionParser("""usage: %prog [options]
+benchmarks the graphios backends
+""")
+parser.add_option("--metrics", dest="metrics", default=10000, type="int",
+                  help="metrics per round (default 10000)")
+parser.add_option("--rounds", dest="rounds", default=20, type="int",
+                  help="rounds per benchmark (default 20)")
+
+
+def make_metrics(num):
+    """
+    returns num metrics spread over hosts and services like a nagios spool
+    file would have them
+    """
+    graphios.cfg.update({'replacement_character': '_',
+                         'reverse_hostname': False,
+                         'replace_hostname': True})
+    metrics = []
+    host = 0
+    while len(metrics) < num:
+        line = ("DATATYPE::SERVICEPERFDATA\tTIMET::1400000000\t"
+                "HOSTNAME::web%03d.example.com\tSERVICEDESC::Disk Usage\t"
+                "SERVICEPERFDATA::'/'=12.5GB;20;30;0;40 "
+                "'/var'=1234MB;;;0;2048 load1=0.52;1;2 pl=0%%;20;60 "
+                "rta=1.234ms;100;500;0\t"
+                "SERVICECHECKCOMMAND::check_disk\tHOSTSTATE::UP\t"
+                "HOSTSTATETYPE::HARD\tSERVICESTATE::OK\t"
+                "SERVICESTATETYPE::HARD\tGRAPHITEPREFIX::nagios\t"
+                "GRAPHITEPOSTFIX::\n" % host)
+        metrics.extend(graphios.parse_line(line))
+        host += 1
+    return metrics[:num]
+
+
+def timeit(func, rounds):
+    """
+    returns the best time of rounds calls to func, and what it returned
+    """
+    best = None
+    for i in xrange(rounds):
+        start = time.time()
+        ret = func()
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return (best, ret)
+
+
+def bench_carbon(metrics, rounds):
+    """
+    encode cost of the carbon plaintext and pickle protocols
+    """
+    print "carbon encoding, %s metrics per round:" % len(metrics)
+    for plaintext in (True, False):
+        carbon = backends.carbon({'carbon_plaintext': plaintext})
+        # first round fills the path cache, like the first graphios run
+        (cold, messages) = timeit(
+            lambda: carbon.convert_messages(metrics), 1)
+        (warm, messages) = timeit(
+            lambda: carbon.convert_messages(metrics), rounds)
+        size = sum(len(m) for m in messages)
+        print ("  %-9s %8.1f ms cold %8.1f ms warm %9s bytes "
+               "%5.1f bytes/metric" % (
+                   plaintext and "plaintext" or "pickle", cold * 1000,
+                   warm * 1000, size, float(size) / len(metrics)))
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    """
+    Answers every POST with a 204 (like influxdb does), counts connections
+    """
+    protocol_version = "HTTP/1.1"
+    wbufsize = -1  # answer in one write, like a real server
+    connections = 0
+
+    def setup(self):
+        StandInHandler.connections += 1
+        BaseHTTPRequestHandler.setup(self)
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        self.send_response(204)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+class StandInServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def bench_http(metrics, rounds):
+    """
+    requests and connection setups for the influxdb backend, with a new
+    connection per request (urllib2, what graphios used to do) and with
+    the connection pool
+    """
+    server = StandInServer(('127.0.0.1', 0), StandInHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    influx = backends.influxdb({
+        'influxdb_servers': '127.0.0.1:%s' % server.server_address[1],
+        'influxdb_user': 'graphios', 'influxdb_password': 'graphios'})
+    url = influx.build_url(influx.influxdb_servers[0])
+    chunks = [[{"name": influx.build_path(m), "columns": ["time", "value"],
+                "points": [[int(m.TIMET) * 1000, m.VALUE]]} for m in chunk]
+              for chunk in influx.chunks(metrics,
+                                         influx.influxdb_max_metrics)]
+
+    def urllib2_send():
+        for chunk in chunks:
+            (body, headers) = influx.url_request(chunk)
+            urllib2.urlopen(urllib2.Request(url, body, headers)).close()
+
+    def pool_send():
+        for chunk in chunks:
+            influx._send(influx.influxdb_servers[0], chunk)
+
+    print "http (influxdb), %s requests of %s metrics per round:" % (
+        len(chunks), influx.influxdb_max_metrics)
+    for (name, func) in (("urllib2", urllib2_send), ("pool", pool_send)):
+        StandInHandler.connections = 0
+        (best, ret) = timeit(func, rounds)
+        print "  %-9s %8.1f ms %8s connections in %s rounds" % (
+            name, best * 1000, StandInHandler.connections, rounds)
+    backends.http_pool.close()
+    server.shutdown()
+
+
+def main():
+    (options, args) = parser.parse_args()
+    metrics = make_metrics(options.metrics)
+    bench_carbon(metrics, options.rounds)
+    bench_http(metrics, options.rounds)
+
+
+if __name__ == '__main__':
+    main()